@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    import-time.py
+# @brief   Measure how long it takes to start Handprint, and check that slow
+#          modules are not imported at startup
+# @author  Handprint contributors
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/handprint
+# =============================================================================
+#
+# Usage: python3 dev/import-time.py [-r RUNS] [-b BUDGET]
+#
+# Imports handprint.__main__ in a fresh Python interpreter RUNS times and
+# prints the median time taken.  Exits with status 1 if any of the modules
+# that should only be loaded when they're used (the GUI toolkit, the spinner,
+# the service client libraries, etc.) were imported, or if the median time
+# exceeds BUDGET seconds.  Run it from the top of the source tree.
+
+import os
+import plac
+import statistics
+import subprocess
+import sys
+
+# Top-level packages that must not be imported just by starting Handprint.
+_LAZY_MODULES = ['wx', 'halo', 'pubsub', 'google', 'grpc', 'requests',
+                 'urllib3', 'asyncio']
+
+_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import handprint.__main__
+elapsed = time.perf_counter() - start
+loaded = sorted(set(m.split('.')[0] for m in sys.modules) & set(sys.argv[1:]))
+print(elapsed, ' '.join(loaded))
+'''
+
+@plac.annotations(
+    runs   = ('number of times to import Handprint (default: 5)', 'option', 'r', int),
+    budget = ('maximum acceptable time in seconds (default: 0.5)', 'option', 'b', float),
+)
+
+def main(runs = 5, budget = 0.5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH = os.path.join(here, '..'))
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', _PROBE] + _LAZY_MODULES,
+                                         env = env, universal_newlines = True)
+        (elapsed, _, loaded) = output.strip().partition(' ')
+        if loaded:
+            print('Imported at startup but should not be: {}'.format(loaded))
+            sys.exit(1)
+        times.append(float(elapsed))
+    median = statistics.median(times)
+    print('Median time to import handprint.__main__: {:.3f} s'.format(median))
+    if median > budget:
+        print('This exceeds the budget of {} s'.format(budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -19,12 +19,9 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from   halo import Halo
-import json
 import os
 from   os import path
 import plac
-import requests
 import sys
 from   sys import exit as exit
 try:
@@ -33,18 +30,23 @@ except:
     pass
 import time
 import traceback
-from   urllib import request
 
 import handprint
-from handprint.constants import ON_WINDOWS, ACCEPTED_FORMATS, KNOWN_METHODS
-from handprint.constants import FORMATS_MUST_CONVERT
+from handprint.constants import ON_WINDOWS, ACCEPTED_FORMATS
+from handprint.constants import COMPRESSION_FORMATS
 from handprint.messages import msg, color, MessageHandlerCLI
-from handprint.progress import ProgressIndicator
-from handprint.network import network_available, download_url
-from handprint.files import files_in_directory, replace_extension, handprint_path
-from handprint.files import readable, writable, filename_extension, convert_image
-from handprint.htr import GoogleHTR
-from handprint.htr import MicrosoftHTR
+from handprint.network import network_available, configure_pools
+from handprint.files import files_in_directory, handprint_path
+from handprint.files import readable, writable, filename_extension
+from handprint.engine import Engine
+from handprint.cache import ResultCache
+from handprint.journal import Journal
+from handprint.store import ResultStore
+from handprint.derivatives import DerivativeStore
+from handprint.htr import method_names, method_class
+from handprint.timing import Recorder, TraceRecorder, add_recorder, remove_recorder
+from handprint.timing import stage
+from handprint.profiling import Profiler, set_profiler, profiler
 from handprint.exceptions import *
 from handprint.debug import set_debug, log
 
@@ -56,9 +58,21 @@ from handprint.debug import set_debug, log
     from_file  = ('read file names or URLs from file "F"',           'option', 'f'),
     list       = ('print list of known methods',                     'flag',   'l'),
     method     = ('use method "M" (default: "all")',                 'option', 'm'),
+    endpoints  = ('send requests for methods to endpoints "E"',      'option', 'e'),
     output     = ('write output to directory "O"',                   'option', 'o'),
     root_name  = ('name downloaded images using root file name "R"', 'option', 'r'),
     given_urls = ('assume have URLs, not files (default: files)',    'flag',   'u'),
+    workers    = ('process "W" images at a time (default: 1)',       'option', 'w'),
+    use_async  = ('use asyncio to work on the images (with -w)',     'flag',   'a'),
+    rate       = ('send at most "T" requests/second to each service', 'option', 't'),
+    together   = ('send each image to all methods at the same time',  'flag',   's'),
+    cache_dir  = ('reuse results cached in directory "K"',           'option', 'k'),
+    resume     = ('record progress in journal "J" & skip work done', 'option', 'j'),
+    store_file = ('put results in database "B" instead of files',    'option', 'b'),
+    compress   = ('compress JSON files with "Z" ("gzip" or "zstd")', 'option', 'z'),
+    timings    = ('write timings of the stages of work to file "I"', 'option', 'i'),
+    trace      = ('write a trace of the work to file "X"',           'option', 'x'),
+    profile    = ('profile "P" ("all" threads or one "worker")',     'option', 'p'),
     quiet      = ('do not print info messages while working',        'flag',   'q'),
     no_color   = ('do not color-code terminal output',               'flag',   'C'),
     debug      = ('turn on debugging (console only)',                'flag',   'D'),
@@ -67,8 +81,12 @@ from handprint.debug import set_debug, log
 )
 
 def main(creds_dir = 'D', from_file = 'F', list = False, method = 'M',
-         output = 'O', given_urls = False, root_name = 'R', quiet = False,
-         no_color = False, debug = False, version = False, *images):
+         endpoints = 'E', output = 'O', given_urls = False, root_name = 'R',
+         workers = 'W', use_async = False, rate = 'T', together = False,
+         cache_dir = 'K', resume = 'J', store_file = 'B', compress = 'Z',
+         timings = 'I', trace = 'X', profile = 'P',
+         quiet = False, no_color = False, debug = False, version = False,
+         *images):
     '''Handprint (a loose acronym of "HANDwritten Page RecognitIoN Test") can
 run alternative optical character recognition (OCR) and handwritten text
 recognition (HTR) methods on images of document pages.
@@ -122,11 +140,19 @@ to write the results in the network locations represented by the URLs.  Also,
 when -u is used, the images and text results will be stored in files whose
 root names have the form "document-N", where "N" is an integer.  The root
 name can be changed using the -r option (/r on Windows).  The image will be
-converted to ordinary JPEG format for maximum compatibility with the
-different OCR services and written to "document-N.jpg", and the URL
-corresponding to each document will be written in a file named
-"document-N.url" so that it is possible to connect each "document-N.jpg" to
-the URL it came from.
+written as it was downloaded to "document-N.E", where "E" is the format
+extension (e.g., "document-N.jpeg"), and the URL corresponding to each
+document will be written in a file named "document-N.url" so that it is
+possible to connect each "document-N.E" to the URL it came from.  Images in
+formats not accepted by the services (JPEG 2000 and TIFF) are converted to
+JPEG in memory before being sent; the converted images are not written to
+disk, for either URLs or files.  When all methods are applied one after the
+other, each image is converted only once: the converted images are kept in
+a temporary directory until the end of the run.  Each page of a multi-page
+TIFF file is treated as a separate image, with results written to files
+named after the file and the page number (e.g., "scan.page2.google.txt"
+for the second page of "scan.tif"); for TIFF files given as URLs, only the
+first page is used.
 
 Credentials for different services need to be provided to Handprint in the
 form of JSON files.  Each service needs a separate JSON file named after the
@@ -137,6 +163,107 @@ directory can be indicated at run-time using the -c command-line option (/c
 on Windows).  The specific format of each credentials file is different for
 each service; please consult the Handprint documentation for more details.
 
+By default, Handprint processes one image at a time.  If given the -w option
+(/w on Windows) with a number N, it will work on N images at the same time,
+which can greatly reduce the time needed to process a large number of images
+because most of the time is spent waiting on network services.  The number
+of requests in flight to any one service is limited separately, so that a
+large value of N does not exceed the services' rate limits.  Results are
+reported in the same order as the images are given, regardless of N.  If
+also given the -a option (/a on Windows), Handprint uses Python's asyncio
+instead of a thread for each image.  Waiting for results from services that
+support it (such as Microsoft's) then takes no thread at all, so N can be
+in the thousands.
+
+Handprint paces the requests it sends to each service so as to stay under
+the service's usual quota, and if a service nevertheless refuses a request
+because of rate limits, Handprint waits for as long as the service asks
+and then sends the request again.  If your account has a lower quota (for
+example, a free tier), use the -t option (/t on Windows) with a number T
+to send no more than T requests per second to each service.
+
+When all methods are used (the default), Handprint normally applies one
+method to all the images before going on to the next method.  If given the
+-s option (/s on Windows), Handprint will instead download and convert each
+image only once, then send it to all the services at the same time.  The
+time taken for each image then becomes that of the slowest service rather
+than the sum of the times of all the services.
+
+If given the -k option (/k on Windows) with a directory, Handprint will keep
+the results it gets from each service in that directory, and the next time
+it is asked to process the same image with the same method, it will use the
+stored results instead of contacting the service again.  Images are
+recognized by their contents, not their names, so this works for renamed
+copies of images too.  Results that have not been used for 30 days are
+removed, as are the least recently used results when the directory grows
+beyond 1 GB.
+
+If given the -j option (/j on Windows) with a file name, Handprint will
+record its progress in that file as it works.  If the run is interrupted
+(for example, because a service stops responding), running Handprint again
+with the same -j option and the same images will skip the images that were
+finished, and only process the ones that failed or were not yet done.  At
+the end of a run, Handprint reports how many images were processed and
+which ones failed.
+
+Handprint normally sends images to the services' usual network addresses.
+The -e option (/e on Windows) can be used to send the requests for some or
+all methods elsewhere instead; its value is a comma-separated list of
+elements of the form "method=endpoint", such as
+
+  -e microsoft=http://localhost:8090/vision/v2.0/,google=localhost:50051
+
+Credentials are not needed for methods given an endpoint, and Handprint
+does not check whether the network is available when -e is used.  This is
+mainly meant for use with the stand-in services that come with Handprint,
+which emulate the real services on the local computer with adjustable
+delays, failure rates and rate limits; run "python3 -m handprint.standin -h"
+for more information.
+
+If given the -b option (/b on Windows) with a file name, Handprint will put
+the results in a database in that file (an SQLite database, created if it
+doesn't exist) instead of writing a text file and a JSON file for each image
+and method.  This is much faster on some file systems when there are many
+images.  The files can be written from the database later, to the names
+they would have had, by running "python3 -m handprint.store" with the name
+of the database file.  The -z option cannot be used together with -b; the
+JSON files can be compressed when they are written from the database.
+
+If given the -z option (/z on Windows), Handprint will compress the JSON
+files it writes, which for some services (notably Google) can be very
+large.  The value must be "gzip" or "zstd" (the latter needs the Python
+package "zstandard").  The compressed files are named with the extension
+".gz" or ".zst" added (e.g., "somefile.google.json.gz").  The text files are
+not compressed.  The results of earlier runs that are kept with the -k
+option are not affected.
+
+If given the -i option (/i on Windows) with a file name, Handprint will time
+each stage of the work on each image (finding the images, downloading,
+converting, reading, sending them to the services, waiting for results and
+writing the outputs) and write the timings in that file, one line of JSON
+per image.  At the end of the run, it adds a summary of the times taken by
+each stage for each service, with the 50th, 95th and 99th percentiles and
+the throughput, and prints the summary as well.
+
+If given the -x option (/x on Windows) with a file name, Handprint will write
+a trace of the work in that file, in the Trace Event Format read by tools
+such as Perfetto (https://ui.perfetto.dev) and chrome://tracing in Chrome.
+The trace shows when each stage of the work on each image was done, and by
+which thread, including the individual calls to Google's service and the
+individual requests made to Microsoft's service while waiting for results.
+This can be used to find out why the work is not going as fast as expected.
+
+If given the -p option (/p on Windows), Handprint will profile itself while
+it works, and at the end write the results to the files "handprint.pstats"
+(a profile made with Python's cProfile, which can be read with the pstats
+module or tools such as snakeviz) and "handprint.collapsed" (samples of the
+stacks of the threads, in the format used by flame graph tools).  They are
+written in the output directory given with -o, or else the current
+directory.  The value of -p must be "all", to profile all the threads, or
+"worker", to profile only one worker (for use with -w).  Profiling only one
+worker slows the rest of the run down less.  Conversions of image formats
+are profiled in either case.
+
 If given the -q option (/q on Windows), Handprint will not print its usual
 informational messages while it is working.  It will only print messages
 for warnings or errors.
@@ -159,12 +286,9 @@ information and exit without doing anything else.
         exit()
     if list:
         say.info('Known methods:')
-        for key in KNOWN_METHODS.keys():
+        for key in method_names():
             say.info('   {}'.format(key))
         exit()
-    if not network_available():
-        exit(say.fatal_text('No network.'))
-
     if from_file == 'F':
         from_file = None
     else:
@@ -175,19 +299,36 @@ information and exit without doing anything else.
         if not readable(from_file):
             exit(say.error_text('File not readable: {}'.format(from_file)))
 
+    if method == 'M':
+        method = 'all'
+    method = method.lower()
+    if method != 'all' and method not in method_names():
+        exit(say.error_text('"{}" is not a known method. {}'.format(method, hint)))
+
+    if endpoints == 'E':
+        endpoints = {}
+    else:
+        endpoints = parse_endpoints(endpoints)
+        if endpoints is None:
+            exit(say.error_text('Option {}e requires "method=endpoint" values. {}'
+                                .format(prefix, hint)))
+        unknown = [name for name in endpoints if name not in method_names()]
+        if unknown:
+            exit(say.error_text('"{}" is not a known method. {}'.format(unknown[0], hint)))
+    # Stand-in services don't need the network.
+    if not endpoints and not network_available():
+        exit(say.fatal_text('No network.'))
+
     if creds_dir == 'D':
         creds_dir = path.join(handprint_path(), 'creds')
-    if not readable(creds_dir):
+    used = method_names() if method == 'all' else [method]
+    if all(name in endpoints for name in used):
+        if __debug__: log('Not using credentials; all methods have endpoints.')
+    elif not readable(creds_dir):
         exit(say.error_text('Directory not readable: {}'.format(creds_dir)))
     else:
         if __debug__: log('Assuming credentials found in "{}".', creds_dir)
 
-    if method == 'M':
-        method = 'all'
-    method = method.lower()
-    if method != 'all' and method not in KNOWN_METHODS:
-        exit(say.error_text('"{}" is not a known method. {}'.format(method, hint)))
-
     if not images and not from_file:
         exit(say.error_text('Need provide images or URLs. {}'.format(hint)))
     if any(item.startswith('-') for item in images):
@@ -211,32 +352,162 @@ information and exit without doing anything else.
     if root_name == 'R':
         root_name = 'document'
 
+    if cache_dir == 'K':
+        cache = None
+    else:
+        if not path.isabs(cache_dir):
+            cache_dir = path.realpath(path.join(os.getcwd(), cache_dir))
+        if path.exists(cache_dir) and not writable(cache_dir):
+            exit(say.error_text('Directory not writable: {}'.format(cache_dir)))
+        cache = ResultCache(cache_dir)
+
+    if together and method != 'all':
+        exit(say.error_text('Option {}s can only be used with all methods.'.format(prefix)))
+
+    if workers == 'W':
+        workers = 1
+    elif not workers.isdigit() or int(workers) < 1:
+        exit(say.error_text('Option {}w requires a positive integer.'.format(prefix)))
+    else:
+        workers = int(workers)
+    # Each worker may be downloading while others talk to the services.
+    configure_pools(pool_size = max(workers, 10))
+
+    if rate == 'T':
+        rate = None
+    else:
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = 0
+        if rate <= 0:
+            exit(say.error_text('Option {}t requires a positive number.'.format(prefix)))
+
+    if resume == 'J':
+        journal = None
+    else:
+        if not path.isabs(resume):
+            resume = path.realpath(path.join(os.getcwd(), resume))
+        if path.exists(resume) and not writable(resume):
+            exit(say.error_text('File not writable: {}'.format(resume)))
+        journal = Journal(resume)
+
+    if store_file != 'B' and compress != 'Z':
+        exit(say.error_text('Option {0}z cannot be used with {0}b; give it to'
+                            ' "python3 -m handprint.store" instead.'.format(prefix)))
+    if store_file == 'B':
+        store = None
+    else:
+        if not path.isabs(store_file):
+            store_file = path.realpath(path.join(os.getcwd(), store_file))
+        if path.exists(store_file) and not writable(store_file):
+            exit(say.error_text('File not writable: {}'.format(store_file)))
+        store = ResultStore(store_file)
+
+    if compress == 'Z':
+        compress = None
+    elif compress not in COMPRESSION_FORMATS:
+        exit(say.error_text('Option {}z must be one of {}.'.format(
+            prefix, ', '.join('"{}"'.format(c) for c in COMPRESSION_FORMATS))))
+    elif compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            exit(say.error_text('Compressing with zstd needs the package zstandard.'))
+
+    recorders = []
+    timer = None
+    if timings == 'I':
+        timings = None
+    else:
+        if not path.isabs(timings):
+            timings = path.realpath(path.join(os.getcwd(), timings))
+        if path.exists(timings) and not writable(timings):
+            exit(say.error_text('File not writable: {}'.format(timings)))
+        timer = Recorder(timings)
+        recorders.append(timer)
+    if trace == 'X':
+        trace = None
+    else:
+        if not path.isabs(trace):
+            trace = path.realpath(path.join(os.getcwd(), trace))
+        if path.exists(trace) and not writable(trace):
+            exit(say.error_text('File not writable: {}'.format(trace)))
+        recorders.append(TraceRecorder(trace))
+    for recorder in recorders:
+        add_recorder(recorder)
+
+    if profile == 'P':
+        profile = None
+    elif profile not in ['all', 'worker']:
+        exit(say.error_text('Option {}p must be "all" or "worker".'.format(prefix)))
+    else:
+        # Without worker threads, the main thread does the work of a worker.
+        one_worker = (profile == 'worker')
+        main_thread = not one_worker or (workers == 1 and not use_async)
+        set_profiler(Profiler(one_worker, main_thread))
+
     # Create a list of files to be processed.
-    targets = targets_from_arguments(images, from_file, given_urls, say)
+    with stage('discovery'):
+        targets = targets_from_arguments(images, from_file, given_urls, say)
     if not targets:
         exit(say.warn_text('No images to process; quitting.'))
 
     # Let's do this thing.
+    derivatives = None
+    settings = dict(given_urls = given_urls, output_dir = output,
+                    root_name = root_name, creds_dir = creds_dir,
+                    endpoints = endpoints, workers = workers, use_async = use_async,
+                    rate = rate, cache = cache, journal = journal, store = store,
+                    compression = compress, say = say)
+    if profiler():
+        profiler().start()
     try:
-        if method == 'all':
+        if method == 'all' and together:
+            say.info('Applying all methods to each image at the same time.')
+            methods = [method_class(name) for name in method_names()]
+            run(methods, targets, **settings)
+        elif method == 'all':
             say.info('Applying all methods in succession.')
-            for m in KNOWN_METHODS.values():
+            # Images that have to be converted are converted only once, and
+            # kept until the last method has used them.
+            methods = [method_class(name) for name in method_names()]
+            derivatives = DerivativeStore(uses = len(methods))
+            for m in methods:
                 if not say.be_quiet():
                     say.msg('='*70, 'dark')
-                run(m, targets, given_urls, output, root_name, creds_dir, say)
+                run([m], targets, derivatives = derivatives, **settings)
             if not say.be_quiet():
                 say.msg('='*70, 'dark')
         else:
-            m = KNOWN_METHODS[method]
-            run(m, targets, given_urls, output, root_name, creds_dir, say)
+            m = method_class(method)
+            run([m], targets, **settings)
     except (KeyboardInterrupt, UserCancelled) as err:
+        report_progress(journal, say)
         exit(say.info_text('Quitting.'))
     except ServiceFailure as err:
+        report_progress(journal, say)
         exit(say.error_text(str(err)))
     except Exception as err:
         if debug:
             import pdb; pdb.set_trace()
         exit(say.error_text('{}\n{}'.format(str(err), traceback.format_exc())))
+    finally:
+        if store:
+            store.close()
+        if journal:
+            journal.close()
+        if derivatives:
+            derivatives.close()
+        for recorder in recorders:
+            remove_recorder(recorder)
+            if recorder is not timer:
+                recorder.close()
+        if timings:
+            report_timings(timer, timings, say)
+        if profiler():
+            report_profile(output or os.getcwd(), say)
+    report_progress(journal, say)
     say.info('Done.')
 
 
@@ -250,81 +521,76 @@ if ON_WINDOWS:
 # Helper functions.
 # ......................................................................
 
-def run(method_class, targets, given_urls, output_dir, root_name, creds_dir, say):
-    spinner = ProgressIndicator(say.use_color(), say.be_quiet())
-    try:
-        tool = method_class()
-        tool_name = tool.name()
-        say.info('Using method "{}".'.format(tool_name))
-        tool.init_credentials(creds_dir)
-        for index, item in enumerate(targets, 1):
-            if not given_urls and (item.startswith('http') or item.startswith('ftp')):
-                say.warn('Skipping URL "{}"'.format(item))
-                continue
-            if say.use_color() and not say.be_quiet():
-                action = 'Downloading' if given_urls else 'Reading'
-                spinner.start('{} {}'.format(action, item))
-            fmt = None
-            if given_urls:
-                # Make sure the URLs point to images.
-                response = request.urlopen(item)
-                if response.headers.get_content_maintype() != 'image':
-                    spinner.fail('Did not find an image at "{}"'.format(item))
-                    continue
-                fmt = response.headers.get_content_subtype()
-                if fmt not in ACCEPTED_FORMATS:
-                    spinner.fail('Cannot use image format {} in "{}"'.format(fmt, item))
-                    continue
-                # If we're given URLs, we have to invent file names to store
-                # the images and the OCR results.
-                base = '{}-{}'.format(root_name, index)
-                url_file = path.realpath(path.join(output_dir, base + '.url'))
-                if __debug__: log('Writing URL to {}', url_file)
-                with open(url_file, 'w') as f:
-                    f.write(url_file_content(item))
-                file = path.realpath(path.join(output_dir, base + '.' + fmt))
-                if __debug__: log('Starting wget on {}', item)
-                (success, error) = download_url(item, file)
-                if not success:
-                    spinner.fail('Failed to download {}: {}'.format(item, error))
-                    continue
-            else:
-                file = path.realpath(path.join(os.getcwd(), item))
-                fmt = filename_extension(file)
-            if output_dir:
-                dest_dir = output_dir
-            else:
-                dest_dir = path.dirname(file)
-                if not writable(dest_dir):
-                    say.fatal('Cannot write output in "{}".'.format(dest_dir))
-                    return
-            if fmt in FORMATS_MUST_CONVERT:
-                spinner.update('Converting file format to JPEG: "{}"'.format(file))
-                (success, converted_file, msg) = convert_image(file, fmt, 'jpeg')
-                if not success:
-                    spinner.fail('Failed to convert "{}": {}'.format(file, msg))
-                # Note: 'file' now points to the converted file, not the original
-                file = converted_file
-            file_name = path.basename(file)
-            base_path = path.join(dest_dir, file_name)
-            txt_file  = replace_extension(base_path, '.' + tool_name + '.txt')
-            json_file = replace_extension(base_path, '.' + tool_name + '.json')
-            spinner.update('Sending to {} for text extraction'.format(tool_name))
-            save_output(tool.document_text(file), txt_file)
-            spinner.update('Text from {} saved in {}'.format(tool_name, txt_file))
-            spinner.update('All data from {} saved in {}'.format(tool_name, json_file))
-            save_output(json.dumps(tool.all_results(file)), json_file)
-            if say.use_color() and not say.be_quiet():
-                short_path = path.relpath(txt_file, os.getcwd())
-                spinner.stop('{} -> {}'.format(item, short_path))
-    except (KeyboardInterrupt, UserCancelled) as err:
-        if spinner:
-            spinner.stop()
-        raise
-    except Exception as err:
-        if spinner:
-            spinner.fail(say.error_text('Stopping due to a problem'))
-        raise
+def run(method_classes, targets, *, given_urls, output_dir, root_name, creds_dir,
+        endpoints, workers, use_async, rate, cache, journal, store, compression,
+        say, derivatives = None):
+    tools = []
+    for cls in method_classes:
+        tool = cls()
+        if tool.name() in endpoints:
+            say.info('Using method "{}" at {}.'.format(tool.name(), endpoints[tool.name()]))
+            tool.set_endpoint(endpoints[tool.name()])
+        else:
+            say.info('Using method "{}".'.format(tool.name()))
+            tool.init_credentials(creds_dir)
+        tool.set_cache(cache)
+        if rate:
+            tool.set_rate_limit(rate)
+        tools.append(tool)
+    engine = Engine(tools, given_urls, output_dir, root_name, workers, say,
+                    journal = journal, derivatives = derivatives, store = store,
+                    compression = compression)
+    if use_async:
+        import asyncio
+        asyncio.run(engine.run_async(targets))
+    else:
+        engine.run(targets)
+
+
+def report_timings(timer, timings_file, say):
+    '''Finishes the timing records in 'timings_file' and prints the summary.'''
+    summary = timer.close()
+    if say.be_quiet():
+        return
+    say.info('Timings (seconds) written to {}:'.format(timings_file))
+    say.info('  {:<10} {:<10} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'stage', 'service', 'count', 'p50', 'p95', 'p99', 'per sec'))
+    for row in summary:
+        say.info('  {:<10} {:<10} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.2f}'.format(
+            row['stage'], row['service'] or '', row['count'], row['p50'],
+            row['p95'], row['p99'], row['throughput']))
+
+
+def report_profile(dest_dir, say):
+    '''Writes the profiling results into files in 'dest_dir'.'''
+    profiler().stop()
+    files = profiler().write(path.join(dest_dir, 'handprint'))
+    set_profiler(None)
+    say.info('Profile written to {}'.format(', '.join(files)))
+
+
+def parse_endpoints(value):
+    '''Parses the value of the -e option, of the form "method=endpoint,...",
+    into a dict mapping method names to endpoints.  Returns None if the
+    value is not of that form.'''
+    endpoints = {}
+    for element in value.split(','):
+        (name, _, endpoint) = element.partition('=')
+        if not name.strip() or not endpoint.strip():
+            return None
+        endpoints[name.strip().lower()] = endpoint.strip()
+    return endpoints
+
+
+def report_progress(journal, say):
+    '''Summarizes the work recorded in the 'journal' during this run.'''
+    if not journal:
+        return
+    statuses = list(journal.summary().values())
+    say.info('{} done, {} failed, {} interrupted.'.format(
+        statuses.count('done'), statuses.count('failed'), statuses.count('started')))
+    for ((item, method), error) in sorted(journal.errors().items()):
+        say.warn('{} failed with {}: {}'.format(item, method, error))
 
 
 def targets_from_arguments(images, from_file, given_urls, say):
@@ -362,10 +628,6 @@ def filter_urls(item_list, say):
     return results
 
 
-def url_file_content(url):
-    return '[InternetShortcut]\nURL={}\n'.format(url)
-
-
 def print_version():
     print('{} version {}'.format(handprint.__title__, handprint.__version__))
     print('Author: {}'.format(handprint.__author__))
@@ -373,10 +635,6 @@ def print_version():
     print('License: {}'.format(handprint.__license__))
 
 
-def save_output(text, file):
-    with open(file, 'w') as f:
-        f.write(text)
-
 # init_halo_hack() is mostly a guess at a way to keep the first part of the
 # spinner printed by Halo from overwriting part of the first message we
 # print.  It seems to work, but the problem that this tries to solve occurred
@@ -0,0 +1,201 @@
+'''
+cache.py: persistent cache of results from HTR services.
+
+Results are stored on disk under a key computed from the contents of the
+image, the name of the HTR method, and the parameters of the request sent
+to the service.  Because the key depends on the image contents and not on
+the file name, renamed or copied images are found in the cache too, while
+changing an image or the request parameters produces a new entry.
+
+Each entry is a small JSON file.  Entries that have not been used for a
+given time, and the least recently used entries when the cache grows too
+large, are evicted automatically.
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+from   collections import OrderedDict
+import hashlib
+import json
+import os
+from   os import path
+import threading
+import time
+
+import handprint
+from handprint.debug import log
+from handprint.files import save_json, load_json
+
+
+# Constants.
+# .............................................................................
+
+_DEFAULT_MAX_BYTES = 1024*1024*1024
+
+_DEFAULT_MAX_AGE = 30*24*60*60          # 30 days, in seconds.
+
+
+# Main class.
+# .............................................................................
+
+class ResultCache(object):
+    '''On-disk cache of results from HTR services.  When the total size of
+    the cache exceeds 'max_bytes', the least recently used entries are
+    removed; entries that have not been used for 'max_age' seconds are never
+    returned and are removed.
+
+    The cache keeps an index of its entries in memory, ordered by when they
+    were last used, along with their total size, so that keeping the cache
+    within its limits doesn't require looking at all the files.  The index
+    is built from the files in the cache directory by a background thread
+    started when the cache is created.'''
+
+    def __init__(self, cache_dir, max_bytes = _DEFAULT_MAX_BYTES,
+                 max_age = _DEFAULT_MAX_AGE):
+        self._dir       = cache_dir
+        self._max_bytes = max_bytes
+        self._max_age   = max_age
+        self._lock      = threading.Lock()
+        self._index     = OrderedDict()     # file -> (last use, size).
+        self._bytes     = 0
+        os.makedirs(cache_dir, exist_ok = True)
+        threading.Thread(target = self.evict, daemon = True,
+                         name = 'handprint-cache-index').start()
+
+
+    def key(self, method, params, image_data):
+        '''Returns the cache key for the results of sending 'image_data' to
+        the HTR 'method' with request parameters 'params' (a dict).'''
+        digest = hashlib.sha256()
+        digest.update(method.encode('utf-8') + b'\n')
+        digest.update(json.dumps(params, sort_keys = True).encode('utf-8') + b'\n')
+        digest.update(image_data)
+        return digest.hexdigest()
+
+
+    def get(self, key):
+        '''Returns the results stored under 'key', or None if there are none.'''
+        file = self._file(key)
+        try:
+            last_use = os.stat(file).st_mtime
+            entry = load_json(file)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        if now - last_use > self._max_age:
+            self._forget([file])
+            return None
+        # Record the use, for deciding which entries to evict.
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+        with self._lock:
+            if file in self._index:
+                self._index[file] = (now, self._index[file][1])
+                self._index.move_to_end(file)
+        if __debug__: log('Found cached results for {}', key)
+        return entry['results']
+
+
+    def put(self, key, results):
+        '''Stores 'results', which must be serializable as JSON, under 'key'.'''
+        file = self._file(key)
+        os.makedirs(path.dirname(file), exist_ok = True)
+        save_json({'created': time.time(), 'results': results}, file)
+        try:
+            size = os.stat(file).st_size
+        except OSError:
+            return
+        with self._lock:
+            self._add(file, time.time(), size)
+            expired = self._expired(time.time())
+        self._forget(expired)
+
+
+    def evict(self):
+        '''Rebuilds the index of the cache from the files in the cache
+        directory, and removes entries that have not been used for too long
+        and then the least recently used entries until the cache is no larger
+        than the maximum size.  This looks at every file in the cache, so it's
+        only done when the cache is created.'''
+        now = time.time()
+        entries = []
+        for (dir, _, files) in os.walk(self._dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue        # Probably being written right now.
+                file = path.join(dir, name)
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file))
+        with self._lock:
+            # Entries used or added while the files were being looked at are
+            # already in the index, and are the most recently used.
+            index = OrderedDict((file, (last_use, size))
+                                for (last_use, size, file) in sorted(entries)
+                                if file not in self._index)
+            index.update(self._index)
+            self._index = index
+            self._bytes = sum(size for (_, size) in index.values())
+            expired = self._expired(now)
+        if __debug__: log('Cache has {} entries using {} bytes', len(self._index),
+                          self._bytes)
+        self._forget(expired)
+
+
+    def _add(self, file, last_use, size):
+        if file in self._index:
+            self._bytes -= self._index[file][1]
+        self._index[file] = (last_use, size)
+        self._index.move_to_end(file)
+        self._bytes += size
+
+
+    def _expired(self, now):
+        '''Removes from the index the entries that are too old or that make
+        the cache too large, and returns a list of their files.  Must be
+        called with the lock held.'''
+        expired = []
+        while self._index:
+            (file, (last_use, size)) = next(iter(self._index.items()))
+            if self._bytes <= self._max_bytes and now - last_use <= self._max_age:
+                break
+            del self._index[file]
+            self._bytes -= size
+            expired.append(file)
+        return expired
+
+
+    def _forget(self, files):
+        with self._lock:
+            for file in files:
+                if file in self._index:
+                    self._bytes -= self._index.pop(file)[1]
+        for file in files:
+            self._remove(file)
+
+
+    def _file(self, key):
+        # Use subdirectories so that no one directory gets too many files.
+        return path.join(self._dir, key[:2], key + '.json')
+
+
+    def _remove(self, file):
+        if __debug__: log('Removing cache file {}', file)
+        try:
+            os.remove(file)
+        except OSError:
+            pass
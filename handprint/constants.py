@@ -17,8 +17,6 @@ file "LICENSE" for more information.
 import sys
 
 import handprint
-from handprint.htr import GoogleHTR
-from handprint.htr import MicrosoftHTR
 
 ON_WINDOWS = sys.platform.startswith('win')
 
@@ -26,7 +24,7 @@ ACCEPTED_FORMATS = ('jpg', 'jpeg', 'jp2', 'png', 'gif', 'bmp', 'tif', 'tiff')
 
 FORMATS_MUST_CONVERT = ('jp2', 'tif', 'tiff')
 
-KNOWN_METHODS = {
-    'google': GoogleHTR,
-    'microsoft': MicrosoftHTR,
-}
+FORMATS_MULTIPAGE = ('tif', 'tiff')
+
+# Compression of JSON output files, and the extensions added to their names.
+COMPRESSION_FORMATS = {'gzip': '.gz', 'zstd': '.zst'}
@@ -0,0 +1,216 @@
+'''
+derivatives.py: store of converted images shared by all methods in a job.
+
+When several HTR methods are applied one after the other to the same images,
+every image in a format that must be converted (such as JPEG 2000) would
+otherwise be decoded and converted once per method.  Decoding such images
+is the most CPU-intensive thing Handprint does locally, so the store keeps
+each converted image in a temporary directory until every method has used
+it.  Converted images are identified by a hash of the contents of the
+original image plus the conversion parameters, and each one is produced
+exactly once even if several threads ask for it at the same time.  The
+space the store takes is also capped: when it is full, the images used
+least recently are deleted, and are converted again if they're needed.
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+from   collections import OrderedDict
+from   concurrent.futures import Future
+import hashlib
+import os
+from   os import path
+import shutil
+import tempfile
+import threading
+
+import handprint
+from handprint.debug import log
+from handprint.files import convert_image_data
+
+
+# Constants.
+# .............................................................................
+
+_CHUNK_SIZE = 1024*1024
+
+# Maximum total size of the converted images kept at any one time.
+_MAX_BYTES = 2*1024*1024*1024
+
+
+# Main class.
+# .............................................................................
+
+class DerivativeStore(object):
+    '''Temporary store of converted images, keyed by content.  Each image
+    is deleted once it has been asked for 'uses' times (if 'uses' is not
+    None), and the images kept take at most 'max_bytes' bytes in total.'''
+
+    def __init__(self, uses = None, max_bytes = _MAX_BYTES):
+        self._dir       = tempfile.mkdtemp(prefix = 'handprint-')
+        self._uses      = uses
+        self._max_bytes = max_bytes
+        self._lock      = threading.Lock()
+        self._entries   = {}
+        self._digests   = {}
+        self._files     = OrderedDict()   # key -> (file, size, uses), LRU order.
+        self._bytes     = 0
+        if __debug__: log('Storing converted images in {}', self._dir)
+
+
+    def convert(self, image, to_format, converter = convert_image_data, frame = 0):
+        '''Returns the result of converting frame 'frame' of 'image' (a file
+        path or bytes) to 'to_format', in the same form as
+        files.convert_image_data().  The conversion is only done the first
+        time a given image is converted to a given format, using the function
+        'converter' (which must take the same arguments as
+        files.convert_image_data()); after that, the stored result is
+        returned.'''
+        try:
+            digest = self._digest(image)
+        except OSError as err:
+            return (False, None, str(err))
+        params = '\n{}\n{}'.format(to_format, frame).encode('utf-8')
+        key = hashlib.sha256(digest + params).hexdigest()
+        with self._lock:
+            future = self._entries.get(key)
+            owner = future is None
+            if owner:
+                future = self._entries[key] = Future()
+        if not owner:
+            # Another thread is doing (or has done) this conversion.
+            try:
+                (success, file, msg) = future.result()
+            except BaseException as err:
+                return (False, None, str(err) or type(err).__name__)
+            if not success:
+                return (False, None, msg)
+            if file is None:
+                # The result could not be stored.
+                return converter(image, to_format, frame)
+            try:
+                with open(file, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                # It was deleted to make room after we got its name.
+                return converter(image, to_format, frame)
+            self._used(key)
+            return (True, data, '')
+        try:
+            (success, converted, msg) = converter(image, to_format, frame)
+        except BaseException as err:
+            # Don't leave waiting threads (or later callers) blocked forever.
+            with self._lock:
+                del self._entries[key]
+            future.set_exception(err)
+            raise
+        if not success:
+            future.set_result((False, None, msg))
+            return (False, None, msg)
+        file = path.join(self._dir, key + '.' + to_format)
+        try:
+            with open(file, 'wb') as f:
+                f.write(converted)
+        except OSError as err:
+            # Don't keep other threads waiting; they'll convert it themselves.
+            if __debug__: log('Unable to store {}: {}', file, str(err))
+            with self._lock:
+                del self._entries[key]
+            future.set_result((True, None, ''))
+            return (True, converted, '')
+        with self._lock:
+            self._files[key] = (file, len(converted), 0)
+            self._bytes += len(converted)
+            self._make_room()
+        future.set_result((True, file, ''))
+        self._used(key)
+        return (True, converted, '')
+
+
+    def _used(self, key):
+        '''Counts a use of the stored image 'key', and deletes it if that
+        was the last use expected.'''
+        with self._lock:
+            if key not in self._files:
+                return
+            (file, size, uses) = self._files[key]
+            uses += 1
+            if self._uses is not None and uses >= self._uses:
+                self._remove(key)
+            else:
+                self._files[key] = (file, size, uses)
+                self._files.move_to_end(key)
+
+
+    def _make_room(self):
+        # Called with the lock held.
+        while self._bytes > self._max_bytes and len(self._files) > 1:
+            self._remove(next(iter(self._files)))
+
+
+    def _remove(self, key):
+        # Called with the lock held.  Later requests for the image will
+        # convert it again.
+        (file, size, _) = self._files.pop(key)
+        self._entries.pop(key, None)
+        self._bytes -= size
+        if __debug__: log('Removing stored image {}', file)
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+
+    def _digest(self, image):
+        '''Returns the digest of the contents of 'image'.  Files are only
+        read the first time, so that the many pages of a multi-page file
+        (each converted separately, and once per method) don't each cost a
+        read of the whole file.'''
+        if not isinstance(image, str):
+            return hashlib.sha256(image).digest()
+        stat = os.stat(image)
+        file_id = (path.realpath(image), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            future = self._digests.get(file_id)
+            owner = future is None
+            if owner:
+                future = self._digests[file_id] = Future()
+        if not owner:
+            return future.result()
+        try:
+            digest = _file_digest(image)
+        except BaseException as err:
+            with self._lock:
+                del self._digests[file_id]
+            future.set_exception(err)
+            raise
+        future.set_result(digest)
+        return digest
+
+
+    def close(self):
+        '''Deletes the stored images.'''
+        if __debug__: log('Removing {}', self._dir)
+        shutil.rmtree(self._dir, ignore_errors = True)
+
+
+# Helper functions.
+# .............................................................................
+
+def _file_digest(file):
+    # Files are read in pieces, because multi-page images can be very large.
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
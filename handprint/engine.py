@@ -0,0 +1,671 @@
+'''
+engine.py: execution engine for applying HTR methods to lists of targets.
+
+The engine takes care of the per-target work of reading or downloading an
+image, converting it to a format accepted by the services, sending it to
+one or more services, and writing the results.  Targets can be processed one
+at a time (the default) or by a pool of worker threads.  In the latter case,
+results are still reported in the same order as the targets were given, so
+that the output of a run does not depend on the order in which network
+requests happen to complete.  When the engine is given more than one HTR
+method, each image is prepared once and then sent to all the methods at the
+same time.
+
+Converting image formats is done in a pool of separate processes, so that
+it can use all the CPU cores of the computer.  The engine also starts
+converting images a little ahead of the targets being worked on, so that
+the conversion of upcoming images overlaps with the network requests for
+the current ones.
+
+Each page of a multi-page TIFF file is treated as a separate target, with
+outputs named after the file and the page number (e.g., "scan.page2.tif"
+produces "scan.page2.google.txt").  The pages are extracted one at a time,
+as they come up for processing, so that a whole document is never decoded
+into memory at once.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2018 by the California Institute of Technology.  Changes made
+in 2026 are copyright (c) 2026 by the Handprint contributors.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+from   concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import os
+from   os import path
+
+import handprint
+from handprint.constants import ACCEPTED_FORMATS, FORMATS_MUST_CONVERT
+from handprint.constants import FORMATS_MULTIPAGE
+from handprint.debug import log
+from handprint.exceptions import *
+from handprint.files import filename_extension, replace_extension, writable
+from handprint.files import convert_image_data, save_output, image_fits
+from handprint.files import reduce_image, image_scale, image_pages
+from handprint.files import save_json, json_bytes, ImageData
+from handprint.network import download_image
+from handprint.progress import ProgressIndicator
+from handprint.timing import stage, working_on, bind, finished
+from handprint.profiling import profile_thread, profiler, call_profiled
+
+
+# Constants.
+# .............................................................................
+
+# How many targets to queue up per worker thread.  Keeping the queue short
+# bounds the memory used on very large runs, while keeping it longer than
+# the number of workers means workers don't sit idle while the main thread
+# is busy reporting results.
+
+_QUEUE_DEPTH_PER_WORKER = 2
+
+# Name of the subdirectory of the output directory where copies of images
+# reduced to fit the limits of the services are stored.  (It must not be
+# the output directory itself, or the copies would be taken for input
+# images when Handprint is run on that directory.)
+
+_REDUCED_DIR = 'handprint-reduced'
+
+# Number of processes used for converting image formats, and thus also the
+# number of images that are converted ahead of the one being worked on.
+
+_CONVERTERS = os.cpu_count() or 1
+
+# Maximum number of threads used for blocking operations when running with
+# asyncio.  Services with a native asynchronous interface don't need a
+# thread while they wait for results, so this only limits how many requests
+# to other services and how many file operations can be in progress at once.
+
+_ASYNC_THREADS = 64
+
+
+# Classes.
+# .............................................................................
+
+class Page(str):
+    '''A target that is one page of a multi-page image file.  It acts as a
+    string of the form "file [page N]", which is how the target is shown in
+    messages and recorded in journals.'''
+
+    def __new__(cls, file, number, count):
+        page = str.__new__(cls, '{} [page {}]'.format(file, number))
+        page.file   = file
+        page.number = number
+        page.count  = count
+        return page
+
+
+    def output_name(self, file):
+        '''Returns a name for the page derived from 'file' (the path of the
+        whole image file), for naming output files.'''
+        (root, ext) = path.splitext(file)
+        width = len(str(self.count))
+        return '{}.page{:0{}d}{}'.format(root, self.number, width, ext)
+
+
+class Engine(object):
+    '''Applies one or more HTR methods to a list of targets.'''
+
+    def __init__(self, tools, given_urls, output_dir, root_name, workers, say,
+                 journal = None, derivatives = None, store = None,
+                 compression = None):
+        self._tools       = tools
+        self._given_urls  = given_urls
+        self._output_dir  = output_dir
+        self._root_name   = root_name
+        self._workers     = max(1, workers)
+        self._say         = say
+        self._journal     = journal
+        self._derivatives = derivatives
+        self._store       = store
+        self._compression = compression
+        self._method_pool = None
+        self._converter   = None
+        self._converting  = None
+        self._conversions = {}
+
+
+    def run(self, targets):
+        '''Processes each of the 'targets' and reports the outcomes.'''
+        say = self._say
+        if len(self._tools) > 1:
+            # Each worker needs a thread per method to wait on the services.
+            self._method_pool = ThreadPoolExecutor(
+                max_workers = self._workers * len(self._tools),
+                initializer = profile_thread)
+        self._start_converters()
+        try:
+            if self._workers > 1:
+                say.info('Processing {} images using {} workers.'.format(
+                    len(targets), self._workers))
+                notify = lambda text: log(text)
+                for outcomes in ordered_map(
+                        lambda job: self._process(job[0], job[1], notify),
+                        enumerate(self._pipeline(targets), 1), self._workers):
+                    for (status, item, text) in outcomes:
+                        self._report(status, item, text)
+            else:
+                self._run_sequentially(self._pipeline(targets))
+        finally:
+            if self._method_pool:
+                self._method_pool.shutdown()
+                self._method_pool = None
+            self._stop_converters()
+
+
+    async def run_async(self, targets):
+        '''Processes each of the 'targets' and reports the outcomes, like
+        run(), but using asyncio.  Up to 'workers' targets are worked on at
+        the same time; because waiting for a service that has an
+        asynchronous interface doesn't need a thread, this can be a large
+        number.  Outcomes are still reported in the order of the targets.'''
+        # asyncio is imported only when used, because it is slow to import.
+        import asyncio
+        self._say.info('Processing {} images with up to {} at a time.'.format(
+            len(targets), self._workers))
+        executor = ThreadPoolExecutor(max_workers = min(self._workers, _ASYNC_THREADS),
+                                      initializer = profile_thread)
+        tools = [tool.asynchronous(executor) for tool in self._tools]
+        notify = lambda text: log(text)
+        self._start_converters()
+        pending = deque()
+        try:
+            for index, item in enumerate(self._pipeline(targets), 1):
+                pending.append(asyncio.ensure_future(
+                    self._process_async(index, item, tools, executor, notify)))
+                if len(pending) >= self._workers:
+                    for (status, item, text) in await pending.popleft():
+                        self._report(status, item, text)
+            while pending:
+                for (status, item, text) in await pending.popleft():
+                    self._report(status, item, text)
+        finally:
+            for task in pending:
+                task.cancel()
+            executor.shutdown()
+            self._stop_converters()
+
+
+    def _start_converters(self):
+        # The converter processes are started fresh rather than forked,
+        # because the gRPC channels and threads of the Google client (and the
+        # locks held by other threads) are not safe to use in a forked child.
+        self._converter = ProcessPoolExecutor(max_workers = _CONVERTERS,
+                                              mp_context = multiprocessing.get_context('spawn'))
+        self._converting = ThreadPoolExecutor(max_workers = _CONVERTERS)
+
+
+    def _stop_converters(self):
+        for future in self._conversions.values():
+            future.cancel()
+        self._conversions = {}
+        self._converting.shutdown()
+        self._converter.shutdown()
+
+
+    def _run_sequentially(self, targets):
+        say = self._say
+        spinner = ProgressIndicator(say.use_color(), say.be_quiet())
+        try:
+            for index, item in enumerate(targets, 1):
+                if not self._remaining_tools(item):
+                    if __debug__: log('Already done: "{}"', item)
+                    continue
+                if say.use_color() and not say.be_quiet():
+                    action = 'Downloading' if self._given_urls else 'Reading'
+                    spinner.start('{} {}'.format(action, item))
+                for (status, item, text) in self._process(index, item, spinner.update):
+                    self._report(status, item, text, spinner)
+        except (KeyboardInterrupt, UserCancelled) as err:
+            spinner.stop()
+            raise
+        except Exception as err:
+            spinner.fail(say.error_text('Stopping due to a problem'))
+            raise
+
+
+    def _report(self, status, item, text, spinner = None):
+        say = self._say
+        if status == 'done':
+            if not say.be_quiet():
+                short_path = path.relpath(text, os.getcwd())
+                if spinner and say.use_color():
+                    spinner.stop('{} -> {}'.format(item, short_path))
+                else:
+                    say.info('{} -> {}'.format(item, short_path))
+        elif status in ['skipped', 'warning']:
+            say.warn(text)
+        elif status == 'resumed':
+            if __debug__: log(text)
+        elif spinner:
+            spinner.fail(text)
+        else:
+            say.error(text)
+
+
+    def _process(self, index, item, notify):
+        '''Processes one target and returns a list of outcomes, one for each
+        HTR method (or a single one if the target could not be prepared).
+        Each outcome is a tuple of (status, item, text), where 'status' is
+        one of 'done', 'skipped', 'resumed' (meaning it was done in an
+        earlier run), 'failed' or 'warning' (which comes in addition to the
+        outcomes of the methods).  If the status is 'done', 'text' is the
+        path of the text output file; otherwise, it is a message explaining
+        what went wrong.'''
+        with working_on(item):
+            try:
+                return self._process_item(index, item, notify)
+            finally:
+                finished(item)
+
+
+    def _process_item(self, index, item, notify):
+        (tools, outcomes) = self._start(item, self._tools)
+        if outcomes:
+            return outcomes
+        try:
+            (file, image, dest_dir) = self._prepare(index, item, notify)
+        except TargetFailure as err:
+            return self._failed(item, tools, err)
+        warnings = self._warnings(item, file)
+        if len(tools) == 1 or not self._method_pool:
+            return warnings + [self._apply(tool, item, file, image, dest_dir, notify)
+                               for tool in tools]
+        # The progress indicator can't be shared by threads, so updates from
+        # the individual methods only go to the debug log.
+        futures = [self._method_pool.submit(bind(self._apply), tool, item, file,
+                                            image, dest_dir, lambda text: log(text))
+                   for tool in tools]
+        return warnings + [future.result() for future in futures]
+
+
+    async def _process_async(self, index, item, tools, executor, notify):
+        '''Does the same as _process(), using the asynchronous interfaces
+        'tools' to the HTR methods, and running blocking operations using
+        'executor'.'''
+        with working_on(item):
+            try:
+                return await self._process_item_async(index, item, tools,
+                                                      executor, notify)
+            finally:
+                finished(item)
+
+
+    async def _process_item_async(self, index, item, tools, executor, notify):
+        import asyncio
+        (tools, outcomes) = self._start(item, tools)
+        if outcomes:
+            return outcomes
+        loop = asyncio.get_event_loop()
+        try:
+            (file, image, dest_dir) = await loop.run_in_executor(
+                executor, bind(self._prepare), index, item, notify)
+        except TargetFailure as err:
+            return self._failed(item, tools, err)
+        warnings = self._warnings(item, file)
+        return warnings + list(await asyncio.gather(*[
+            self._apply_async(tool, item, file, image, dest_dir, executor, notify)
+            for tool in tools]))
+
+
+    def _start(self, item, tools):
+        '''Starts work on 'item' and returns a tuple of (tools, outcomes).
+        'tools' are those among the given 'tools' that remain to be applied
+        to the item.  If 'outcomes' is not empty, there is nothing to do and
+        these are the outcomes to report.'''
+        if not self._given_urls and (item.startswith('http') or item.startswith('ftp')):
+            return ([], [('skipped', item, 'Skipping URL "{}"'.format(item))])
+        tools = self._remaining_tools(item, tools)
+        if not tools:
+            return ([], [('resumed', item, 'Already done: "{}"'.format(item))])
+        if self._journal:
+            for tool in tools:
+                self._journal.started(item, tool.name())
+        return (tools, [])
+
+
+    def _failed(self, item, tools, err):
+        '''Records that 'item' could not be prepared, and returns the
+        outcomes to report.'''
+        if self._journal:
+            for tool in tools:
+                self._journal.failed(item, tool.name(), str(err))
+        return [('failed', item, str(err))]
+
+
+    def _warnings(self, item, file):
+        '''Returns a list of outcomes for things to warn about 'item'.'''
+        if (self._given_urls and filename_extension(file) in FORMATS_MULTIPAGE
+                and image_pages(file) > 1):
+            # Pages can only be split out beforehand for local files.
+            return [('warning', item, 'Only the first page of {} was used'.format(item))]
+        return []
+
+
+    def _remaining_tools(self, item, tools = None):
+        '''Returns the list of methods (from 'tools', or all of them if it's
+        None) that still have to be applied to 'item', leaving out those
+        that the journal says are done.'''
+        if tools is None:
+            tools = self._tools
+        if not self._journal:
+            return tools
+        # Results in a store may have been lost if the run was interrupted
+        # before they were committed.
+        return [t for t in tools if not self._journal.completed(item, t.name())
+                or (self._store and not self._store.contains(item, t.name()))]
+
+
+    def _apply(self, tool, item, file, image, dest_dir, notify):
+        try:
+            txt_file = self._recognize(tool, item, file, image, dest_dir, notify)
+            return self._applied(tool, item, txt_file)
+        except TargetFailure as err:
+            return self._applied(tool, item, None, err)
+
+
+    async def _apply_async(self, tool, item, file, image, dest_dir, executor, notify):
+        try:
+            txt_file = await self._recognize_async(tool, item, file, image, dest_dir,
+                                                   executor, notify)
+            return self._applied(tool, item, txt_file)
+        except TargetFailure as err:
+            return self._applied(tool, item, None, err)
+
+
+    def _applied(self, tool, item, txt_file, err = None):
+        '''Records the outcome of applying 'tool' to 'item' and returns it.'''
+        if err:
+            if self._journal:
+                self._journal.failed(item, tool.name(), str(err))
+            return ('failed', item, str(err))
+        if self._journal:
+            self._journal.done(item, tool.name(), txt_file)
+        return ('done', item, txt_file)
+
+
+    def _prepare(self, index, item, notify):
+        '''Gets the image for 'item' in a format the services accept, and
+        returns a tuple of (file, image, destination directory for outputs).
+        'file' is the local file for the item, and is used to name the output
+        files.  'image' is what is sent to the services: either the same file
+        path, or the image data if it's in memory (as it is after converting
+        the format of the image, or after downloading a small image).'''
+        if self._given_urls:
+            (file, image) = self._fetch(index, item)
+        else:
+            file = self._local_file(item)
+            image = file
+        fmt = filename_extension(file)
+        if self._output_dir:
+            dest_dir = self._output_dir
+        else:
+            dest_dir = path.dirname(file)
+            if not writable(dest_dir):
+                raise TargetFailure('Cannot write output in "{}".'.format(dest_dir))
+        if isinstance(item, Page):
+            notify('Extracting page {} of "{}"'.format(item.number, file))
+            name = item.output_name(file)
+        elif fmt in FORMATS_MUST_CONVERT:
+            notify('Converting file format to JPEG: "{}"'.format(file))
+            name = file
+        else:
+            return (file, image, dest_dir)
+        future = self._conversions.pop(item, None)
+        if future:
+            (success, image, msg) = future.result()
+        else:
+            (success, image, msg) = self._convert(image, _frame(item))
+        if not success:
+            raise TargetFailure('Failed to convert "{}": {}'.format(item, msg))
+        return (name, ImageData(image), dest_dir)
+
+
+    def _pipeline(self, targets):
+        '''Yields the targets to process: the elements of 'targets', with
+        multi-page image files replaced by their pages.  The conversion of
+        the images of the next few targets is started before each one is
+        yielded.'''
+        upcoming = deque()
+        for item in self._pages(targets):
+            upcoming.append(item)
+            self._start_conversion(item)
+            if len(upcoming) > _CONVERTERS:
+                yield upcoming.popleft()
+        while upcoming:
+            yield upcoming.popleft()
+
+
+    def _pages(self, targets):
+        '''Yields the elements of 'targets', except that local multi-page
+        image files are replaced by a Page object for each of their pages.
+        Only the headers of the files are read here.'''
+        for item in targets:
+            if self._given_urls or filename_extension(item) not in FORMATS_MULTIPAGE:
+                yield item
+                continue
+            try:
+                with stage('discovery'):
+                    count = image_pages(self._local_file(item))
+            except Exception as err:
+                # Let the usual processing report the problem.
+                if __debug__: log('Unable to count pages of {}: {}', item, str(err))
+                count = 1
+            if count == 1:
+                yield item
+                continue
+            if __debug__: log('{} has {} pages', item, count)
+            for number in range(1, count + 1):
+                yield Page(item, number, count)
+
+
+    def _start_conversion(self, item):
+        # Images at URLs can't be converted until they're downloaded.
+        if self._given_urls or not self._remaining_tools(item):
+            return
+        file = self._local_file(item)
+        if isinstance(item, Page) or filename_extension(file) in FORMATS_MUST_CONVERT:
+            if __debug__: log('Starting conversion of {}', item)
+            self._conversions[item] = self._converting.submit(
+                self._convert_ahead, item, file)
+
+
+    def _convert_ahead(self, item, file):
+        with working_on(item):
+            return self._convert(file, _frame(item))
+
+
+    def _local_file(self, item):
+        name = item.file if isinstance(item, Page) else item
+        return path.realpath(path.join(os.getcwd(), name))
+
+
+    def _convert(self, image, frame = 0):
+        '''Converts frame 'frame' of 'image' to JPEG in a separate process,
+        and returns the result in the same form as files.convert_image_data().'''
+        with stage('convert'):
+            if self._derivatives:
+                # Other engines in this job may have converted it already.
+                return self._derivatives.convert(image, 'jpeg',
+                                                 self._convert_in_process, frame)
+            return self._convert_in_process(image, 'jpeg', frame)
+
+
+    def _convert_in_process(self, image, to_format, frame = 0):
+        if profiler():
+            (result, stats) = self._converter.submit(
+                call_profiled, convert_image_data, image, to_format, frame).result()
+            profiler().add_stats(stats)
+            return result
+        return self._converter.submit(convert_image_data, image, to_format,
+                                      frame).result()
+
+
+    def _fetch(self, index, item):
+        '''Downloads the image at URL 'item' and returns a tuple of (local
+        file path, image), where 'image' is the image data if the download
+        was small enough to keep in memory, or else the file path.'''
+        # If we're given URLs, we have to invent file names to store the
+        # images and the OCR results.  The names are based on the position
+        # of the URL in the list of targets, not on the order in which
+        # downloads complete, so that they're the same from run to run.
+        base = '{}-{}'.format(self._root_name, index)
+        dest_root = path.realpath(path.join(self._output_dir, base))
+        if __debug__: log('Starting download of {}', item)
+        with stage('download'):
+            (success, file, data, error) = download_image(item, dest_root,
+                                                          ACCEPTED_FORMATS)
+        if not success:
+            raise TargetFailure('Failed to download {}: {}'.format(item, error))
+        url_file = dest_root + '.url'
+        if __debug__: log('Writing URL to {}', url_file)
+        with stage('write'):
+            save_output(url_file_content(item), url_file)
+        return (file, file if data is None else ImageData(data))
+
+
+    def _recognize(self, tool, item, file, image, dest_dir, notify):
+        '''Sends 'image' to the service and writes the results into files in
+        'dest_dir', named after 'file'.  Returns the path of the text output
+        file.'''
+        (image, scale) = self._fit(tool, file, image, dest_dir, notify)
+        notify('Sending to {} for text extraction'.format(tool.name()))
+        results = tool.all_results(image)
+        error = tool.results_error(results)
+        if error:
+            raise TargetFailure(error)
+        text = tool.document_text(image)
+        return self._save(tool, item, file, image, dest_dir, scale, results, text,
+                          notify)
+
+
+    async def _recognize_async(self, tool, item, file, image, dest_dir, executor,
+                               notify):
+        '''Does the same as _recognize(), using the asynchronous interface
+        'tool' to the HTR method, and running blocking operations using
+        'executor'.'''
+        import asyncio
+        loop = asyncio.get_event_loop()
+        (image, scale) = await loop.run_in_executor(
+            executor, bind(self._fit), tool, file, image, dest_dir, notify)
+        notify('Sending to {} for text extraction'.format(tool.name()))
+        results = await tool.all_results(image)
+        error = tool.results_error(results)
+        if error:
+            raise TargetFailure(error)
+        text = await tool.document_text(image)
+        return await loop.run_in_executor(executor, bind(self._save), tool, item,
+                                          file, image, dest_dir, scale, results,
+                                          text, notify)
+
+
+    def _save(self, tool, item, file, image, dest_dir, scale, results, text, notify):
+        '''Writes the 'results' and the 'text' obtained from 'tool' for
+        'image' into files in 'dest_dir', named after 'file'.  Returns the
+        path of the text output file.  The JSON file is compressed if the
+        engine was given a compression format.  If there is a result store,
+        the results are put in the store under 'item' instead, and the files
+        are only named.'''
+        tool_name = tool.name()
+        base_path = path.join(dest_dir, path.basename(file))
+        txt_file  = replace_extension(base_path, '.' + tool_name + '.txt')
+        json_file = replace_extension(base_path, '.' + tool_name + '.json')
+        if scale != 1.0:
+            # Record how to map coordinates in the results (e.g., of bounding
+            # boxes) back to the original image: divide them by the scale.
+            results = dict(results, handprint = {'scale': scale})
+            if isinstance(image, str):
+                results['handprint']['image'] = image
+        with stage('write', tool_name):
+            if self._store:
+                self._store.add(item, tool_name, txt_file, json_file, text,
+                                json_bytes(results).decode('utf-8'))
+                notify('Results from {} stored for {}'.format(tool_name, item))
+                return txt_file
+            save_output(text, txt_file)
+            notify('Text from {} saved in {}'.format(tool_name, txt_file))
+            json_file = save_json(results, json_file, self._compression)
+        notify('All data from {} saved in {}'.format(tool_name, json_file))
+        return txt_file
+
+
+    def _fit(self, tool, file, image, dest_dir, notify):
+        '''Returns a tuple of (image, scale).  If 'image' is within the limits
+        of the service used by 'tool', the result is the given image and a
+        scale of 1.  Otherwise, it is a reduced copy of the image and the
+        scale factor of the reduction.  Reduced copies of images in files are
+        kept in a subdirectory of 'dest_dir' and reused if they're newer than
+        the original file; images in memory are reduced in memory.'''
+        limits = (tool.max_image_bytes, tool.max_image_dimension, tool.max_image_pixels)
+        if image_fits(image, *limits):
+            return (image, 1.0)
+        notify('Reducing image to fit limits of {}: "{}"'.format(tool.name(), file))
+        if not isinstance(image, str):
+            with stage('convert', tool.name()):
+                (success, data, scale, msg) = reduce_image(image, None, *limits)
+            if not success:
+                raise TargetFailure('Failed to reduce "{}": {}'.format(file, msg))
+            return (ImageData(data), scale)
+        reduced_dir = path.join(dest_dir, _REDUCED_DIR)
+        reduced_file = path.join(reduced_dir, replace_extension(
+            path.basename(image), '.' + tool.name() + '.jpeg'))
+        if (path.exists(reduced_file)
+                and path.getmtime(reduced_file) >= path.getmtime(image)
+                and image_fits(reduced_file, *limits)):
+            if __debug__: log('Reusing reduced image {}', reduced_file)
+            return (reduced_file, image_scale(reduced_file, image))
+        os.makedirs(reduced_dir, exist_ok = True)
+        with stage('convert', tool.name()):
+            (success, _, scale, msg) = reduce_image(image, reduced_file, *limits)
+        if not success:
+            raise TargetFailure('Failed to reduce "{}": {}'.format(file, msg))
+        return (reduced_file, scale)
+
+
+# Helper functions.
+# .............................................................................
+
+def ordered_map(func, items, workers):
+    '''Applies 'func' to each element of 'items' using a pool of 'workers'
+    threads, and yields the results in the same order as 'items'.  Only a
+    limited number of items are scheduled ahead of the one whose result is
+    awaited, so 'items' can be a long list or a generator.  An exception
+    raised by 'func' is re-raised here, after canceling the items that
+    have not yet been started.
+    '''
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers = workers,
+                            initializer = profile_thread) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= workers * _QUEUE_DEPTH_PER_WORKER:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _frame(item):
+    # Pages are numbered from 1 but frames in image files from 0.
+    return item.number - 1 if isinstance(item, Page) else 0
+
+
+def url_file_content(url):
+    return '[InternetShortcut]\nURL={}\n'.format(url)
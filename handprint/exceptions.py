@@ -25,3 +25,7 @@ class ServiceFailure(Exception):
 class InternalError(Exception):
     '''Unrecoverable problem involving Handprint itself.'''
     pass
+
+class TargetFailure(Exception):
+    '''Problem processing one target; other targets can still be processed.'''
+    pass
@@ -14,15 +14,26 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+import gzip
+import io
+import json
 import os
 from   os import path
 from   PIL import Image
 import sys
 import subprocess
+import threading
 import webbrowser
 
+# orjson is much faster than the json module for the large results returned
+# by some services, but it's optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import handprint
-from handprint.constants import ON_WINDOWS
+from handprint.constants import ON_WINDOWS, COMPRESSION_FORMATS
 from handprint.debug import log
 
 
@@ -31,6 +42,12 @@ from handprint.debug import log
 
 _HANDPRINT_REG_PATH = r'Software\Caltech Library\Handprint\Settings'
 
+# Settings for reduce_image().  The first attempt uses the higher quality,
+# and later ones (if needed) trade some quality for smaller files.
+_JPEG_QUALITY        = 90
+_JPEG_LOW_QUALITY    = 80
+_MAX_REDUCE_ATTEMPTS = 6
+
 
 # Main functions.
 # .............................................................................
@@ -153,6 +170,88 @@ def open_url(url):
     webbrowser.open(url)
 
 
+def save_output(text, file):
+    '''Writes 'text' to 'file'.  The text is first written to a temporary
+    file that is then renamed, so that readers (and later runs) never see a
+    partially written file even if several threads are writing outputs.'''
+    tmp_file = '{}.{}.tmp'.format(file, threading.get_ident())
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, file)
+
+
+def save_json(obj, file, compression = None):
+    '''Writes 'obj' as JSON to 'file', compressed using 'compression' (one of
+    the keys of constants.COMPRESSION_FORMATS) if it's not None, in which
+    case the extension for the compression is added to the name of the
+    file.  Returns the name of the file written.'''
+    if compression:
+        file += COMPRESSION_FORMATS[compression]
+    save_data(json_bytes(obj), file, compression)
+    return file
+
+
+def save_data(data, file, compression = None):
+    '''Writes the bytes 'data' to 'file', compressing them on the way using
+    'compression' if it's not None.  Like save_output(), this writes to a
+    temporary file that is then renamed.'''
+    tmp_file = '{}.{}.tmp'.format(file, threading.get_ident())
+    with open(tmp_file, 'wb') as f:
+        if compression == 'gzip':
+            # A low level is nearly as compact for JSON, and much faster.
+            with gzip.GzipFile(fileobj = f, mode = 'wb', compresslevel = 3,
+                               mtime = 0) as stream:
+                stream.write(data)
+        elif compression == 'zstd':
+            import zstandard
+            with zstandard.ZstdCompressor().stream_writer(f, closefd = False) as stream:
+                stream.write(data)
+        else:
+            f.write(data)
+    os.replace(tmp_file, file)
+
+
+def load_json(file):
+    '''Reads the JSON in 'file', which may be compressed, and returns the
+    object.  If 'file' doesn't exist but a compressed version of it (with
+    the extension of one of constants.COMPRESSION_FORMATS added) does, that
+    is read instead.'''
+    if not path.exists(file):
+        for extension in COMPRESSION_FORMATS.values():
+            if path.exists(file + extension):
+                file += extension
+                break
+    with open(file, 'rb') as f:
+        if file.endswith(COMPRESSION_FORMATS['gzip']):
+            with gzip.GzipFile(fileobj = f) as stream:
+                data = stream.read()
+        elif file.endswith(COMPRESSION_FORMATS['zstd']):
+            import zstandard
+            with zstandard.ZstdDecompressor().stream_reader(f) as stream:
+                data = stream.read()
+        else:
+            data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_bytes(obj):
+    '''Returns 'obj' encoded as JSON, in UTF-8.'''
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson is stricter about some things, such as very large ints.
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+
+class ImageData(bytes):
+    '''Image data in memory that can remember the key identifying it (see
+    htr.base.image_key()), so that the data is hashed only once however many
+    times the key is needed.'''
+    key = None
+
+
 def convert_image(file, from_format, to_format):
     '''Returns a tuple of (success, output file, error message).'''
     dest_file = filename_basename(file) + '.' + to_format
@@ -163,3 +262,109 @@ def convert_image(file, from_format, to_format):
         return (True, dest_file, '')
     except Exception as err:
         return (False, None, str(err))
+
+
+def convert_image_data(image, to_format, frame = 0):
+    '''Converts 'image' (a file path or bytes) to 'to_format' in memory.  If
+    the image has more than one frame (e.g., it's a multi-page TIFF file),
+    only the one numbered 'frame' (counting from 0) is converted.  Returns a
+    tuple of (success, converted image data, error message).'''
+    try:
+        im = Image.open(_image_file(image))
+        if frame:
+            # Only the requested frame is decoded, not the ones before it.
+            im.seek(frame)
+        if to_format in ['jpeg', 'jpg'] and im.mode not in ['RGB', 'L', 'CMYK']:
+            im = im.convert('RGB')
+        buffer = io.BytesIO()
+        im.save(buffer, to_format)
+        if __debug__: log('Converted image to {} in memory', to_format)
+        return (True, buffer.getvalue(), '')
+    except Exception as err:
+        return (False, None, str(err))
+
+
+def image_pages(image):
+    '''Returns the number of pages (frames) in 'image' (a file path or bytes).
+    Only the headers of the pages are read, not the pixel data.'''
+    with Image.open(_image_file(image)) as im:
+        return getattr(im, 'n_frames', 1)
+
+
+def image_fits(image, max_bytes = None, max_dimension = None, max_pixels = None):
+    '''Returns True if 'image' (a file path or bytes) is no larger than
+    'max_bytes' bytes, has no side longer than 'max_dimension' pixels, and
+    has no more than 'max_pixels' pixels in total.  Limits that are None
+    are ignored.'''
+    size = path.getsize(image) if isinstance(image, str) else len(image)
+    if max_bytes and size > max_bytes:
+        return False
+    if max_dimension or max_pixels:
+        # Opening an image only reads its header, not the pixel data.
+        with Image.open(_image_file(image)) as im:
+            (width, height) = im.size
+        if max_dimension and max(width, height) > max_dimension:
+            return False
+        if max_pixels and width * height > max_pixels:
+            return False
+    return True
+
+
+def image_scale(file, original_file):
+    '''Returns the ratio of the width of the image in 'file' to the width of
+    the image in 'original_file'.'''
+    with Image.open(file) as im, Image.open(original_file) as original:
+        return im.size[0] / original.size[0]
+
+
+def reduce_image(image, dest_file = None, max_bytes = None, max_dimension = None,
+                 max_pixels = None):
+    '''Makes a JPEG version of 'image' (a file path or bytes), reduced in
+    size as needed to fit the limits described for image_fits().  If
+    'dest_file' is given, the result is also written to that file.  Returns
+    a tuple of (success, reduced image data, scale factor, error message),
+    where the scale factor is the ratio of the new width (and height) to the
+    original one.'''
+    try:
+        im = Image.open(_image_file(image))
+        (width, height) = im.size
+        scale = 1.0
+        if max_dimension:
+            scale = min(scale, max_dimension / max(width, height))
+        if max_pixels:
+            scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+        # For JPEG files, draft() makes the decoder do most of the scaling,
+        # which is much faster than decoding at full size and then resizing.
+        im.draft('RGB', (int(width * scale), int(height * scale)))
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        for attempt in range(_MAX_REDUCE_ATTEMPTS):
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            if im.size != size:
+                # reducing_gap makes Pillow shrink by an integer factor with
+                # reduce() before the (slower) resampling step.
+                reduced = im.resize(size, Image.LANCZOS, reducing_gap = 2.0)
+            else:
+                reduced = im
+            buffer = io.BytesIO()
+            quality = _JPEG_QUALITY if attempt == 0 else _JPEG_LOW_QUALITY
+            reduced.save(buffer, 'jpeg', quality = quality, optimize = True)
+            data = buffer.getvalue()
+            if not max_bytes or len(data) <= max_bytes:
+                if dest_file:
+                    with open(dest_file, 'wb') as f:
+                        f.write(data)
+                    if __debug__: log('Saved reduced image (scale {:.3f}) to {}',
+                                      scale, dest_file)
+                return (True, data, scale, '')
+            # JPEG size is roughly proportional to the number of pixels.  Aim
+            # a little below the limit so that we usually succeed next time.
+            scale *= 0.95 * (max_bytes / len(data)) ** 0.5
+        return (False, None, scale, 'could not reduce image to {} bytes'.format(max_bytes))
+    except Exception as err:
+        return (False, None, 1.0, str(err))
+
+
+def _image_file(image):
+    '''Returns something that PIL.Image.open() can read 'image' from.'''
+    return image if isinstance(image, str) else io.BytesIO(image)
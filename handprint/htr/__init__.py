@@ -1,2 +1,35 @@
-from .google import GoogleHTR
-from .microsoft import MicrosoftHTR
+'''
+Registry of the HTR methods known to Handprint.
+
+The modules that implement the methods import the client libraries of the
+services, which are large and slow to load, so they are only imported when
+a method is actually used.
+'''
+
+import importlib
+
+# Map of method names to the classes implementing them, as "module.Class".
+KNOWN_METHODS = {
+    'google':    'handprint.htr.google.GoogleHTR',
+    'microsoft': 'handprint.htr.microsoft.MicrosoftHTR',
+}
+
+
+def method_names():
+    '''Returns the names of the known methods, in the order they are used.'''
+    return list(KNOWN_METHODS.keys())
+
+
+def method_class(name):
+    '''Returns the class implementing the method called 'name', importing
+    its module if necessary.'''
+    (module, _, class_name) = KNOWN_METHODS[name].rpartition('.')
+    return getattr(importlib.import_module(module), class_name)
+
+
+def __getattr__(name):
+    # Lets "from handprint.htr import GoogleHTR" and the like keep working.
+    for (method, class_path) in KNOWN_METHODS.items():
+        if class_path.endswith('.' + name):
+            return method_class(method)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -1,10 +1,62 @@
 '''
 htr/base.py: base class definition for HTR systems.
+
+The methods that take an image accept either the path to an image file, a
+bytes object containing the image, or a binary file-like object (such as an
+io.BytesIO) from which the image can be read.  This lets images that were
+downloaded or converted in memory be sent to services without first being
+written to disk.  File-like objects have to be seekable (or have a
+getvalue() method), because the image is read more than once.  Images in
+memory are identified by a hash of their contents; to hash them only once,
+wrap bytes in files.ImageData.
+
+Each HTR object also has an asynchronous interface, obtained by calling its
+asynchronous() method, for use with asyncio.  By default, it runs the
+methods of the synchronous interface in a pool of threads; services that
+can wait for results without tying up a thread provide their own.
 '''
 
+import asyncio
+from   concurrent.futures import Future
+from   contextlib import contextmanager
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import threading
+import time
+import weakref
+
+import handprint
+from handprint.debug import log
+from handprint.files import ImageData
+from handprint.timing import stage, bind
+
 class HTR(object):
+    # Maximum number of requests that Handprint will have outstanding to
+    # this service at any one time, no matter how many workers are used.
+    max_requests = 4
+
+    # Maximum number of requests per second that Handprint will send to
+    # this service with the same credentials, or None for no limit.  This
+    # should be a little under the service's quota, so that requests are
+    # paced rather than refused.
+    max_rate = None
+
+    # Limits on the images accepted by this service: the size of the file
+    # in bytes, the length of the longer side, and the total number of
+    # pixels.  None means there is no limit.  Larger images are reduced to
+    # fit before they're sent.
+    max_image_bytes     = None
+    max_image_dimension = None
+    max_image_pixels    = None
+
     def __init__(self):
-        pass
+        self._request_slots = threading.BoundedSemaphore(self.max_requests)
+        self._cache = None
+        self._limiter = None
+        self._endpoint = None
 
 
     def init_credentials(self):
@@ -17,11 +69,512 @@ class HTR(object):
         pass
 
 
-    def document_text(self, path):
+    def set_cache(self, cache):
+        '''Tells this object to look for results in the ResultCache 'cache'
+        before sending images to the service, and to store new results in
+        it.'''
+        self._cache = cache
+
+
+    def set_endpoint(self, endpoint):
+        '''Tells this object to send requests to 'endpoint' instead of the
+        service's usual address; for example, to use a stand-in service for
+        testing (see handprint.standin).  The form of 'endpoint' depends on
+        the service.  Credentials are not needed when an endpoint is set.'''
+        self._endpoint = endpoint
+
+
+    def set_rate_limit(self, rate):
+        '''Sets the maximum number of requests per second sent to the service
+        to 'rate', instead of the default for the service.'''
+        self.max_rate = rate
+        self._limiter = None
+
+
+    def request_params(self):
+        '''Returns a dict of the parameters that subclasses send to the
+        service along with an image.  Results for the same image obtained
+        with different parameters are cached separately.'''
+        return {}
+
+
+    @contextmanager
+    def request_slot(self, cost = 1):
+        '''Returns a context manager that subclasses hold while sending each
+        request to the service.  It limits the number of simultaneous
+        requests to the value of 'max_requests', and paces them so that
+        there are no more than 'max_rate' per second.  'cost' is the number
+        of requests that the service counts against its quota for this one
+        (e.g., the number of images in a batch).'''
+        with self._request_slots:
+            self.rate_limiter().take(cost)
+            yield
+
+
+    def rate_limiter(self):
+        '''Returns the RateLimiter shared by all objects using this service
+        with the same credentials.'''
+        if self._limiter is None:
+            self._limiter = rate_limiter(self.name(), self._credentials_id(),
+                                         self.max_rate)
+        return self._limiter
+
+
+    def rate_limited(self, delay):
+        '''Tells this object that the service refused a request because of
+        rate limits, and asked for requests to resume after 'delay' seconds.
+        Requests with the same credentials are held back until then.'''
+        if __debug__: log('{} is rate-limiting us; pausing {}s', self.name(), delay)
+        self.rate_limiter().pause(delay)
+
+
+    def document_text(self, image):
         '''Returns the pure text extracted from the image by this service.'''
         pass
 
 
-    def all_results(self, path):
+    def all_results(self, image):
         '''Returns all the results from the service as a Python dict.'''
         pass
+
+
+    def results_error(self, results):
+        '''Returns a message describing the problem if 'results', as returned
+        by all_results(), show that the service failed to process the image,
+        or None if they don't.  all_results() returns a string in place of
+        the results when it can't send the image; subclasses should override
+        this to also recognize the errors reported by the service.'''
+        if isinstance(results, str):
+            return results
+        return None
+
+
+    def asynchronous(self, executor = None):
+        '''Returns an AsyncHTR object for using this service with asyncio.
+        Blocking calls are run using the concurrent.futures.Executor
+        'executor', or the event loop's default executor if it is None.'''
+        return AsyncHTR(self, executor)
+
+
+    def _cached_results(self, image_data):
+        '''Returns the cached results for 'image_data', or None.'''
+        if self._cache is None:
+            return None
+        return self._cache.get(self._cache_key(image_data))
+
+
+    def _cache_results(self, image_data, results):
+        '''Stores 'results' for 'image_data' in the cache, if there is one.'''
+        if self._cache is not None:
+            self._cache.put(self._cache_key(image_data), results)
+
+
+    def _cache_key(self, image_data):
+        return self._cache.key(self.name(), self.request_params(), image_data)
+
+
+    def _credentials_id(self):
+        '''Returns a value identifying the credentials used for the service.
+        Services that have rate limits per account should override this.'''
+        return None
+
+
+class AsyncHTR(object):
+    '''Asynchronous interface to an HTR service, for use with asyncio.
+
+    This wraps an HTR object and provides coroutine versions of its methods
+    document_text() and all_results().  Other attributes (such as name()
+    and the image limits) are those of the wrapped object.  This class runs
+    the methods of the wrapped object in threads; subclasses can override
+    the coroutines to avoid holding a thread while waiting on the service.
+    '''
+
+    def __init__(self, htr, executor = None):
+        self._htr      = htr
+        self._executor = executor
+
+
+    def __getattr__(self, name):
+        return getattr(self._htr, name)
+
+
+    async def document_text(self, image):
+        '''Returns the pure text extracted from the image by this service.'''
+        return await self._call(self._htr.document_text, image)
+
+
+    async def all_results(self, image):
+        '''Returns all the results from the service as a Python dict.'''
+        return await self._call(self._htr.all_results, image)
+
+
+    async def _call(self, func, *args):
+        '''Runs func(*args) in the executor and returns the result.'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor,
+                                          bind(functools.partial(func, *args)))
+
+
+# Helper classes and functions.
+# -----------------------------------------------------------------------------
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def rate_limiter(service, credentials, rate):
+    '''Returns the RateLimiter for the service named 'service' used with
+    'credentials', creating it with the given 'rate' if there isn't one.'''
+    # Keep only a hash of the credentials, which may be secret.
+    digest = hashlib.sha1(str(credentials).encode('utf-8')).hexdigest()
+    with _rate_limiters_lock:
+        key = (service, digest)
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(rate)
+        elif _rate_limiters[key].rate != rate:
+            _rate_limiters[key].rate = rate
+        return _rate_limiters[key]
+
+
+class RateLimiter(object):
+    '''Token bucket for pacing requests to a service.
+
+    Tokens accumulate at 'rate' per second, up to 'burst' tokens (by default,
+    one second's worth), and each request takes one or more tokens.  A rate
+    of None means requests are not paced.  Separately, pause() holds back
+    all requests for a time, which is what a service asks for when it
+    refuses a request because of rate limits (HTTP status 429).
+    '''
+
+    def __init__(self, rate, burst = None):
+        self.rate          = rate
+        self._burst        = burst
+        self._tokens       = self._capacity()
+        self._updated      = time.monotonic()
+        self._paused_until = 0
+        self._lock         = threading.Lock()
+
+
+    def take(self, tokens = 1):
+        '''Waits until 'tokens' tokens are available, and takes them.'''
+        wait = self.reserve(tokens)
+        if wait > 0:
+            if __debug__: log('Waiting {:.2f}s for rate limit', wait)
+            time.sleep(wait)
+
+
+    def reserve(self, tokens = 1):
+        '''Takes 'tokens' tokens and returns the number of seconds to wait
+        before using them.  (Requests are served in the order in which they
+        reserve tokens, so this never has to be retried.)'''
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0, self._paused_until - now)
+            if self.rate:
+                self._refill(now)
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    # During a pause, tokens only start to accumulate again
+                    # at the end of the pause.
+                    wait += -self._tokens / self.rate
+            return wait
+
+
+    def pause(self, seconds):
+        '''Holds back all requests for 'seconds' seconds.'''
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Don't let tokens saved up before the pause, or during it, cause
+            # a burst of requests right after it.
+            self._refill(now)
+            self._tokens = min(self._tokens, 0)
+            self._updated = self._paused_until
+
+
+    def _capacity(self):
+        return self._burst or max(1, self.rate or 1)
+
+
+    def _refill(self, now):
+        if now <= self._updated:
+            return                      # We're in a pause.
+        if self.rate:
+            self._tokens = min(self._capacity(),
+                               self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+# Keys of file-like objects, which are hashed only once for the same reason.
+_stream_keys = weakref.WeakKeyDictionary()
+
+
+def image_data(image):
+    '''Returns the contents of 'image' as bytes.  'image' can be the path to
+    a file, a bytes-like object, or a binary file-like object.  File-like
+    objects are read from the beginning, and must have a getvalue() method
+    or be seekable, so that they can be read more than once; otherwise,
+    this raises ValueError.'''
+    if isinstance(image, str):
+        with stage('read'):
+            with io.open(image, 'rb') as image_file:
+                return image_file.read()
+    if isinstance(image, bytes):
+        return image
+    if isinstance(image, (bytearray, memoryview)):
+        return bytes(image)
+    if hasattr(image, 'getvalue'):
+        return image.getvalue()
+    if not image.seekable():
+        raise ValueError('Image streams must be seekable; read it into bytes first')
+    image.seek(0)
+    return image.read()
+
+
+def image_key(image):
+    '''Returns a string identifying 'image', for use as a key in the results
+    that HTR objects keep.  For files, this is the path of the file; for
+    images in memory, it is based on a hash of the contents, which is only
+    computed once for ImageData and file-like objects.'''
+    if isinstance(image, str):
+        return image
+    if isinstance(image, ImageData):
+        if image.key is None:
+            image.key = _data_key(image)
+        return image.key
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return _data_key(image)
+    key = _stream_keys.get(image)
+    if key is None:
+        key = _stream_keys[image] = _data_key(image_data(image))
+    return key
+
+
+def _data_key(data):
+    return '<image {}>'.format(hashlib.sha1(data).hexdigest())
+
+
+class RequestBatcher(object):
+    '''Combines requests made by different threads into batches.
+
+    Each thread calls submit() with a key and the data for one item, and
+    gets back the result for that item.  Items submitted at around the same
+    time are handed together to the function 'send', which must accept a
+    list of (key, data) tuples and return a dict mapping keys to results.
+    A batch is sent when it reaches 'max_items' items or 'max_bytes' bytes
+    of data, or after waiting 'window' seconds for other threads to submit
+    their items.  Threads that may be about to call submit() should first
+    enter the context manager returned by caller(); this lets the batcher
+    avoid waiting at all when only one thread is using it.
+    '''
+
+    def __init__(self, send, max_items, max_bytes, window = 0.05):
+        self._send      = send
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._window    = window
+        self._cond      = threading.Condition()
+        self._pending   = []
+        self._callers   = 0
+        self._gathering = False
+
+
+    @contextmanager
+    def caller(self):
+        with self._cond:
+            self._callers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._callers -= 1
+                self._cond.notify_all()
+
+
+    def submit(self, key, data):
+        '''Returns the result for 'data', as computed by 'send'.'''
+        entry = {'key': key, 'data': data, 'taken': False, 'done': False}
+        with self._cond:
+            self._pending.append(entry)
+            self._cond.notify_all()
+        while True:
+            with self._cond:
+                # Wait until our item is done, or until it is still pending
+                # and no other thread is gathering a batch, in which case we
+                # gather the next one ourselves.
+                self._cond.wait_for(lambda: entry['done'] or not (
+                    entry['taken'] or self._gathering))
+                if entry['done']:
+                    break
+                self._gathering = True
+                self._cond.wait_for(self._batch_ready, timeout = self._window)
+                batch = self._take_batch()
+                self._gathering = False
+                self._cond.notify_all()
+            self._send_batch(batch)
+        if 'error' in entry:
+            raise entry['error']
+        return entry['result']
+
+
+    def _batch_ready(self):
+        '''Returns True if the pending items make a full batch, or if there
+        are no more threads that might add to them.'''
+        if len(self._pending) >= min(self._max_items, self._callers):
+            return True
+        return sum(len(e['data']) for e in self._pending) >= self._max_bytes
+
+
+    def _take_batch(self):
+        items = [(e['key'], e['data']) for e in self._pending]
+        batch = split_batches(items, self._max_items, self._max_bytes)[0]
+        entries = self._pending[:len(batch)]
+        self._pending = self._pending[len(batch):]
+        for e in entries:
+            e['taken'] = True
+        return entries
+
+
+    def _send_batch(self, entries):
+        try:
+            results = self._send([(e['key'], e['data']) for e in entries])
+        except Exception as err:
+            results = None
+            error = err
+        with self._cond:
+            for e in entries:
+                if results is None:
+                    e['error'] = error
+                else:
+                    e['result'] = results[e['key']]
+                e['done'] = True
+            self._cond.notify_all()
+
+
+class OperationPoller(object):
+    '''Polls the status of many long-running operations from one thread.
+
+    Some services (such as Microsoft's) return the location of an operation
+    that has to be polled until its results are ready.  Instead of having
+    every caller sleep and poll on its own, callers hand the operation to
+    poll(), which returns a Future that is given the result as soon as the
+    operation is done.  All pending operations are polled from a single
+    background thread, with a delay between polls of each operation that
+    starts at 'first_delay' seconds and grows by 'factor' up to 'max_delay'.
+    If the service says how long to wait, that is used instead.
+
+    The function 'fetch' is called with an operation's location, in the
+    context (in the sense of the contextvars module) in which poll() was
+    called, and must
+    return a tuple of (done, result, delay), where 'done' is True if the
+    operation has finished, 'result' is its result if so, and 'delay' is the
+    number of seconds the service asked us to wait before polling again
+    (or None if it didn't say).  If 'fetch' raises an exception, the Future
+    is given the exception, unless the network.RetryPolicy 'retry' says to
+    try again, in which case the operation is polled again after the delay
+    given by the policy.  If 'max_wait' is not None and the operation is
+    still not done that many seconds after poll() was called, the Future is
+    given a TimeoutError.
+    '''
+
+    def __init__(self, fetch, first_delay = 0.5, max_delay = 5, factor = 1.5,
+                 retry = None, max_wait = None):
+        self._fetch       = fetch
+        self._first_delay = first_delay
+        self._max_delay   = max_delay
+        self._factor      = factor
+        self._retry       = retry
+        self._max_wait    = max_wait
+        self._cond        = threading.Condition()
+        self._queue       = []
+        self._counter     = itertools.count()
+        self._thread      = None
+
+
+    def poll(self, location, delay = None):
+        '''Starts polling the operation at 'location' and returns a Future
+        for its result.  The first poll happens after 'delay' seconds, or
+        after the default initial delay if 'delay' is None.'''
+        future = Future()
+        if delay is None:
+            delay = self._first_delay
+        fetch = bind(self._fetch)
+        deadline = None if self._max_wait is None else time.monotonic() + self._max_wait
+        with self._cond:
+            self._schedule(fetch, location, delay, delay, deadline, future, 1)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True,
+                                                name = 'handprint-poller')
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+
+    def pending(self):
+        '''Returns the number of operations still being polled.'''
+        with self._cond:
+            return len(self._queue)
+
+
+    def _schedule(self, fetch, location, wait, delay, deadline, future, attempt):
+        if deadline is not None:
+            if time.monotonic() >= deadline:
+                text = 'Operation at {} not done after {} seconds'.format(
+                    location, self._max_wait)
+                future.set_exception(TimeoutError(text))
+                return
+            # Make a last poll at the deadline rather than giving up early.
+            wait = min(wait, deadline - time.monotonic())
+        # The counter breaks ties so that heapq never compares futures.
+        entry = (time.monotonic() + wait, next(self._counter), fetch, location,
+                 delay, deadline, future, attempt)
+        heapq.heappush(self._queue, entry)
+
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                entry = heapq.heappop(self._queue)
+            (_, _, fetch, location, delay, deadline, future, attempt) = entry
+            if future.cancelled():
+                continue
+            try:
+                (done, result, wait) = fetch(location)
+            except Exception as err:
+                if self._retry and self._retry.retry(err, attempt):
+                    if __debug__: log('Will poll {} again after error: {}', location, err)
+                    with self._cond:
+                        self._schedule(fetch, location, self._retry.delay(attempt),
+                                       delay, deadline, future, attempt + 1)
+                else:
+                    future.set_exception(err)
+                continue
+            if done:
+                future.set_result(result)
+                continue
+            delay = min(delay * self._factor, self._max_delay)
+            with self._cond:
+                self._schedule(fetch, location, delay if wait is None else wait,
+                               delay, deadline, future, 1)
+
+
+def split_batches(items, max_items, max_bytes):
+    '''Splits 'items', a list of (key, data) tuples, into a list of lists
+    of items such that each list has at most 'max_items' items and at most
+    'max_bytes' of data in total.  An item whose data is by itself larger
+    than 'max_bytes' is put in a list by itself.'''
+    batches = []
+    batch = []
+    size = 0
+    for (key, data) in items:
+        if batch and (len(batch) >= max_items or size + len(data) > max_bytes):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((key, data))
+        size += len(data)
+    if batch:
+        batches.append(batch)
+    return batches
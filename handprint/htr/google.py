@@ -2,24 +2,64 @@
 google.py: interface to Google HTR network service
 '''
 
-import io
 import os
 from os import path
 import google
 from google.cloud import vision_v1p3beta1 as gv
-from google.api_core.exceptions import PermissionDenied
+from google.api_core.exceptions import PermissionDenied, ResourceExhausted
+from google.api_core.exceptions import ServiceUnavailable, DeadlineExceeded
+from google.api_core import grpc_helpers
+import grpc
 from google.cloud.vision import enums
 from google.cloud.vision import types
 from google.protobuf.json_format import MessageToDict
 import json
+import threading
 
 import handprint
 from handprint.credentials.google_auth import GoogleCredentials
 from handprint.messages import msg
 from handprint.exceptions import ServiceFailure
 from handprint.debug import log
+from handprint.timing import stage
+from handprint.network import RetryPolicy
 
-from .base import HTR
+from .base import HTR, RequestBatcher, image_data, image_key
+
+
+# Constants.
+# -----------------------------------------------------------------------------
+# Limits on a single call to the images:annotate endpoint, from
+# https://cloud.google.com/vision/quotas as of 2018-11-15.  The byte limit
+# is for JSON requests, where image data is base64-encoded; gRPC requests
+# carry the raw bytes, so staying under it leaves plenty of headroom.
+
+_MAX_REQUESTS_PER_CALL = 16
+_MAX_BYTES_PER_CALL    = 10*1024*1024
+
+# How many times to resend a call that the service refused because the quota
+# was exceeded, and how long to wait before doing so.  (The service doesn't
+# say how long to wait; the quota is counted per minute.)
+
+_MAX_REQUEUES = 10
+_RETRY_AFTER  = 15
+
+# Settings for the gRPC channel to the service.  Keepalive pings stop the
+# connection from being dropped by the server or by firewalls when there are
+# pauses between requests (e.g., while images are being downloaded), so that
+# requests don't have to wait for a new connection and TLS handshake.
+
+_SCOPES = ('https://www.googleapis.com/auth/cloud-platform',)
+
+# Hint for the text recognition features that the text is handwritten.
+_LANGUAGE_HINTS = ['en-t-i0-handwrit']
+
+_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+]
 
 
 # Main class.
@@ -36,10 +76,43 @@ class GoogleHTR(HTR):
                        'label_detection', 'text_detection',
                        'document_text_detection', 'image_properties']
 
+    # Fields of an AnnotateImageResponse (as converted by MessageToDict) that
+    # hold the results of each feature.  Features that write to the same
+    # fields can't share a request: if both text_detection and
+    # document_text_detection are requested together, Google only returns
+    # the results of the latter.
+    _feature_fields = {
+        'face_detection':          ['faceAnnotations'],
+        'landmark_detection':      ['landmarkAnnotations'],
+        'crop_hints':              ['cropHintsAnnotation'],
+        'label_detection':         ['labelAnnotations'],
+        'text_detection':          ['textAnnotations', 'fullTextAnnotation'],
+        'document_text_detection': ['textAnnotations', 'fullTextAnnotation'],
+        'image_properties':        ['imagePropertiesAnnotation'],
+    }
+
+    # Google's default quota is 1800 requests per minute, which leaves
+    # plenty of headroom for this many simultaneous requests.  The quota
+    # counts each image in a call (and each group of features) separately.
+    max_requests = 8
+    max_rate     = 25
+
+    # https://cloud.google.com/vision/docs/supported-files states that image
+    # files can't exceed 20 MB, and that images larger than 75 megapixels
+    # are reduced by the service anyway.
+    max_image_bytes  = 20*1024*1024
+    max_image_pixels = 75*1000*1000
+
 
     def __init__(self):
         '''Initializes the credentials to use for accessing this service.'''
+        super().__init__()
         self._results = {}
+        self._client_lock = threading.Lock()
+        self._annotator = None
+        self._retry = RetryPolicy(transient_grpc_error)
+        (max_images, max_bytes) = self._batch_limits()
+        self._batcher = RequestBatcher(self._annotate, max_images, max_bytes)
 
 
     def init_credentials(self, credentials_dir = None):
@@ -55,47 +128,215 @@ class GoogleHTR(HTR):
         return "google"
 
 
-    def document_text(self, path):
+    def request_params(self):
+        '''Returns a dict of the parameters sent to the service with an image.'''
+        return {'features': self._known_features, 'language_hints': _LANGUAGE_HINTS}
+
+
+    def document_text(self, image):
         '''Returns the pure text extracted from the image by this service.'''
-        if path not in self._results:
-            self.all_results(path)      # Sets self._results as side-effect.
-        return self._results[path]['document_text_detection']['fullTextAnnotation']['text']
+        key = image_key(image)
+        if key not in self._results:
+            self.all_results(image)     # Sets self._results as side-effect.
+        result = self._results[key]['document_text_detection']
+        # There is no fullTextAnnotation if no text was found at all.
+        return result.get('fullTextAnnotation', {}).get('text', '')
 
 
-    def all_results(self, path):
+    def all_results(self, image):
         '''Returns all the results from the service as a Python dict.'''
         # Check if we already processed it.
-        if path in self._results:
-            return self._results[path]
+        key = image_key(image)
+        if key in self._results:
+            return self._results[key]
+
+        with self._batcher.caller():
+            data = self._image_data(image, key)
+            if isinstance(data, str):
+                return data
+            cached = self._cached_results(data)
+            if cached is not None:
+                self._results[key] = cached
+                return cached
+            # If other threads are also sending images, this will combine
+            # them into a single call to the service.
+            with stage('rpc', self.name()):
+                return self._batcher.submit(key, data)
 
-        if __debug__: log('Reading {}', path)
-        with io.open(path, 'rb') as image_file:
-            image_data = image_file.read()
+
+    def results_error(self, results):
+        '''Returns a message describing the problem if 'results' show that
+        the service failed to process the image, or None if they don't.'''
+        if isinstance(results, str):
+            return results
+        for (feature, result) in results.items():
+            if 'error' in result:
+                error = result['error']
+                if isinstance(error, dict):
+                    error = error.get('message') or error.get('code')
+                return 'Google reported an error for {} -- {}'.format(feature, error)
+        return None
+
+
+    def _image_data(self, image, key):
+        '''Returns the contents of 'image', or an error message string if the
+        service can't accept the image.'''
+        if __debug__: log('Reading {}', key)
+        data = image_data(image)
 
         # Google Cloud Vision API docs state that images cannot exceed 20 MB:
         # https://cloud.google.com/vision/docs/supported-files
-        if len(image_data) > 20*1024*1024:
-            text = 'Error: file "{}" is too large for Google service'.format(path)
+        if len(data) > 20*1024*1024:
+            text = 'Error: file "{}" is too large for Google service'.format(key)
             msg(text, 'warn')
             return text
+        return data
+
+
+    def _batch_limits(self):
+        '''Returns a tuple of (maximum number of images, maximum total bytes)
+        for the images that can be sent to the service in one call.'''
+        # Each image is sent once per group of features (see _annotate()),
+        # and the service's limits apply to the total.
+        copies = len(self._feature_groups())
+        return (max(1, _MAX_REQUESTS_PER_CALL // copies), _MAX_BYTES_PER_CALL // copies)
+
+
+    def _annotate(self, images):
+        '''Sends the images in 'images', a list of (key, image data) tuples,
+        to the service in one call and returns a dict mapping each key to
+        its results (or an error message string).'''
+        keys = [key for (key, _) in images]
         try:
-            if __debug__: log('Building Google vision API object')
-            client  = gv.ImageAnnotatorClient()
-            image   = gv.types.Image(content = image_data)
-            context = gv.types.ImageContext(language_hints = ['en-t-i0-handwrit'])
+            client  = self._client()
+            context = gv.types.ImageContext(language_hints = _LANGUAGE_HINTS)
 
-            # Iterate over the known API calls and store each result.
+            # Ask for all the features in a single call.  Each image is sent
+            # once per group of features that can share a request (see the
+            # comments for _feature_fields), and the responses are split back
+            # into a separate result for each feature.  The service returns
+            # the responses in the same order as the requests.
+            groups = self._feature_groups()
+            requests = []
+            for (_, data) in images:
+                image = gv.types.Image(content = data)
+                requests += [gv.types.AnnotateImageRequest(
+                                 image = image, image_context = context,
+                                 features = [self._feature(f) for f in group])
+                             for group in groups]
+            if __debug__: log('Sending {} images to Google for {} ...',
+                              len(images), ', '.join(self._known_features))
+            response = self._send(client, requests)
+            if __debug__: log('Received result.')
             results = {}
-            for feature in self._known_features:
-                if __debug__: log('Sending image to Google for {} ...', feature)
-                response = getattr(client, feature)(image = image, image_context = context)
-                if __debug__: log('Received result.')
-                results[feature] = MessageToDict(response)
-            self._results[path] = results
+            responses = iter(response.responses)
+            for (key, data) in images:
+                results[key] = {}
+                for group in groups:
+                    annotations = MessageToDict(next(responses))
+                    results[key].update(self._split_response(group, annotations))
+                self._results[key] = results[key]
+                # Don't keep results for images the service failed on.
+                if not any('error' in r for r in results[key].values()):
+                    self._cache_results(data, results[key])
             return results
         except google.api_core.exceptions.PermissionDenied as err:
             text = 'Authentication failure for Google service -- {}'.format(err)
             raise ServiceFailure(text)
         except Exception as err:
-            text = 'Error: failed to convert "{}": {}'.format(path, err)
-            return text
+            return {key: 'Error: failed to convert "{}": {}'.format(key, err)
+                    for key in keys}
+
+
+    def _send(self, client, requests):
+        '''Makes the call to the service for the AnnotateImageRequests in
+        'requests'.  If the service refuses it because the quota has been
+        exceeded, waits and makes it again.  Transient errors are retried
+        by the retry policy.'''
+        for attempt in range(_MAX_REQUEUES):
+            try:
+                return self._retry.call(self._batch_annotate, client, requests)
+            except ResourceExhausted as err:
+                if __debug__: log('Google refused the call; requeueing: {}', err)
+                self.rate_limited(_RETRY_AFTER)
+        return self._retry.call(self._batch_annotate, client, requests)
+
+
+    def _batch_annotate(self, client, requests):
+        with self.request_slot(len(requests)):
+            # Retries are done by _send(), not by the client library, so that
+            # they follow the same policy as the other services.
+            with stage('call', self.name()):
+                return client.batch_annotate_images(requests, retry = None)
+
+
+    def _credentials_id(self):
+        return os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+
+
+    def _client(self):
+        '''Returns the client object for the service, creating it the first
+        time this is called.  The client is thread-safe and is shared by all
+        threads for the lifetime of this object, so that the cost of opening
+        a connection and loading credentials is paid only once.'''
+        with self._client_lock:
+            if self._annotator is None:
+                if __debug__: log('Building Google vision API object')
+                if self._endpoint:
+                    # A stand-in service at "host:port", without TLS or credentials.
+                    channel = grpc.insecure_channel(self._endpoint,
+                                                    options = _CHANNEL_OPTIONS)
+                else:
+                    channel = grpc_helpers.create_channel(
+                        gv.ImageAnnotatorClient.SERVICE_ADDRESS, scopes = _SCOPES,
+                        options = _CHANNEL_OPTIONS)
+                # Start connecting now, without waiting, so that the
+                # connection may be ready by the time the first image is.
+                grpc.channel_ready_future(channel)
+                self._annotator = gv.ImageAnnotatorClient(channel = channel)
+            return self._annotator
+
+
+    def _feature_groups(self):
+        '''Returns a list of lists of features, such that the features in
+        each list can be requested together in one AnnotateImageRequest.'''
+        groups = []
+        for feature in self._known_features:
+            fields = set(self._feature_fields[feature])
+            for group in groups:
+                if not any(fields & set(self._feature_fields[f]) for f in group):
+                    group.append(feature)
+                    break
+            else:
+                groups.append([feature])
+        return groups
+
+
+    def _feature(self, feature):
+        '''Returns a Feature object for the feature named 'feature'.'''
+        return gv.types.Feature(type = getattr(gv.enums.Feature.Type, feature.upper()))
+
+
+    def _split_response(self, features, response):
+        '''Splits a dict made from an AnnotateImageResponse for a request
+        carrying 'features' into a dict of results keyed by feature name,
+        with the same layout as the response for a single-feature request.'''
+        results = {}
+        for feature in features:
+            result = {field: response[field] for field in self._feature_fields[feature]
+                      if field in response}
+            if 'error' in response:
+                result['error'] = response['error']
+            results[feature] = result
+        return results
+
+
+# Helper functions.
+# -----------------------------------------------------------------------------
+
+def transient_grpc_error(err):
+    '''Returns True if 'err', an exception raised by the Google client
+    library, represents an error that may go away if the call is made again
+    (e.g., the gRPC status UNAVAILABLE, which is also what a connection
+    reset results in).'''
+    return isinstance(err, (ServiceUnavailable, DeadlineExceeded))
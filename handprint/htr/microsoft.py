@@ -5,28 +5,66 @@ This code was originally based on the sample provided by Microsoft at
 https://docs.microsoft.com/en-us/azure/cognitive-services/computer-vision/quickstarts/python-hand-text
 '''
 
+import asyncio
 import os
 from   os import path
 import requests
 from requests.exceptions import HTTPError
 import sys
-import time
 
 import handprint
 from handprint.credentials.microsoft_auth import MicrosoftCredentials
-from handprint.htr.base import HTR
+from handprint.htr.base import HTR, AsyncHTR, OperationPoller, image_data, image_key
 from handprint.messages import msg
 from handprint.exceptions import ServiceFailure
 from handprint.debug import log
+from handprint.timing import stage
+from handprint.network import http_session, set_host_pool_size
+from handprint.network import RetryPolicy, RETRYABLE_STATUS, transient_http_error
+
+
+# Constants.
+# -----------------------------------------------------------------------------
+
+_VISION_BASE_URL = 'https://westus.api.cognitive.microsoft.com/vision/v2.0/'
+
+# How many times to resubmit an image that the service refused because of
+# rate limits, and how long to wait if the service doesn't say.
+
+_MAX_REQUEUES = 10
+_DEFAULT_RETRY_AFTER = 10
+
+# How long to keep polling for the results of an image before giving up.
+
+_MAX_POLL_WAIT = 600
 
 
 # Main class.
 # -----------------------------------------------------------------------------
 
 class MicrosoftHTR(HTR):
+    # Azure's standard tier accepts 10 transactions per second, and each
+    # image takes one submission plus at least one poll.
+    max_requests = 4
+    max_rate     = 8
+
+    # https://docs.microsoft.com/en-us/azure/cognitive-services/computer-vision/home
+    # states that images must be less than 4 MB and no more than 4200
+    # pixels wide or high.
+    max_image_bytes     = 4*1024*1024 - 1
+    max_image_dimension = 4200
+
     def __init__(self):
         '''Initializes the credentials to use for accessing this service.'''
+        super().__init__()
         self._results = {}
+        self.credentials = None
+        self._retry = RetryPolicy(transient_http_error)
+        self._poller = OperationPoller(self._poll, retry = self._retry,
+                                       max_wait = _MAX_POLL_WAIT)
+        # Every request to the service holds a request slot, so this many
+        # connections is enough for them never to wait for one another.
+        set_host_pool_size(_VISION_BASE_URL, self.max_requests)
 
 
     def init_credentials(self, credentials_dir = None):
@@ -35,44 +73,128 @@ class MicrosoftHTR(HTR):
         self.credentials = MicrosoftCredentials(credentials_dir).creds()
 
 
+    def set_endpoint(self, endpoint):
+        '''Tells this object to send requests to 'endpoint', which must be a
+        URL ending in "/" to which "recognizeText" can be appended.'''
+        super().set_endpoint(endpoint)
+        set_host_pool_size(endpoint, self.max_requests)
+
+
     def name(self):
         '''Returns the canonical internal name for this service.'''
         return "microsoft"
 
 
-    def document_text(self, path):
-        if path not in self._results:
-            self.all_results(path)      # Sets self._results as side-effect.
-        lines = self._results[path]['recognitionResult']['lines']
+    def request_params(self):
+        '''Returns a dict of the parameters sent to the service with an image.'''
+        return {'mode': 'Handwritten'}
+
+
+    def document_text(self, image):
+        '''Returns the pure text extracted from the image by this service.'''
+        key = image_key(image)
+        if key not in self._results:
+            self.all_results(image)     # Sets self._results as side-effect.
+        lines = self._results[key]['recognitionResult']['lines']
         sorted_lines = sorted(lines, key = lambda x: (x['boundingBox'][1], x['boundingBox'][0]))
         return ' '.join(x['text'] for x in sorted_lines)
 
 
-    def all_results(self, path):
+    def all_results(self, image):
         '''Returns all the results from the service as a Python dict.'''
+        (results, operation) = self._submit(image)
+        if operation is None:
+            return results
+        # The Microsoft API for extracting handwritten text requires two API
+        # calls: one call to submit the image for processing, the other to
+        # retrieve the text found in the image.  We have to poll and wait
+        # until a result is available.  The poller does this for all pending
+        # images together, and hands back each result as soon as it's ready.
+        if __debug__: log('Polling MS for results ...')
+        (_, _, location, delay) = operation
+        try:
+            with stage('poll', self.name()):
+                analysis = self._poller.poll(location, delay).result()
+        except requests.exceptions.RequestException as err:
+            return network_error(err)
+        except TimeoutError as err:
+            return 'MS service did not return results -- {}'.format(err)
+        return self._finish(operation, analysis)
+
+
+    def results_error(self, results):
+        '''Returns a message describing the problem if 'results' show that
+        the service failed to process the image, or None if they don't.'''
+        if isinstance(results, str):
+            return results
+        if 'error' in results:
+            error = results['error']
+            if isinstance(error, dict):
+                error = error.get('message') or error.get('code')
+            return 'MS service reported an error -- {}'.format(error)
+        if results.get('status') == 'Failed':
+            return 'MS service failed to recognize text in the image'
+        if 'recognitionResult' not in results:
+            return 'MS service returned no recognition results'
+        return None
+
+
+    def asynchronous(self, executor = None):
+        '''Returns an AsyncHTR object for using this service with asyncio.'''
+        return AsyncMicrosoftHTR(self, executor)
+
+
+    def _submit(self, image):
+        '''Submits 'image' to the service, unless the results are already
+        known.  Returns a tuple of (results, operation).  If 'operation' is
+        None, 'results' are the results (or an error message string).
+        Otherwise, 'operation' describes the recognition operation that was
+        started, and has to be given to _finish() with its outcome.'''
         # Check if we already processed it.
+        path = image_key(image)
         if path in self._results:
-            return self._results[path]
+            return (self._results[path], None)
 
-        vision_base_url = "https://westus.api.cognitive.microsoft.com/vision/v2.0/"
-        text_recognition_url = vision_base_url + "recognizeText"
+        text_recognition_url = (self._endpoint or _VISION_BASE_URL) + "recognizeText"
 
         headers = {'Ocp-Apim-Subscription-Key': self.credentials,
                    'Content-Type': 'application/octet-stream'}
-        params  = {'mode': 'Handwritten'}
-        image_data = open(path, 'rb').read()
+        params  = self.request_params()
+        data = image_data(image)
 
         # https://docs.microsoft.com/en-us/azure/cognitive-services/computer-vision/home
         # states "The file size of the image must be less than 4 megabytes (MB)"
-        if len(image_data) > 4*1024*1024:
+        if len(data) > 4*1024*1024:
             text = 'File "{}" is too large for Microsoft service'.format(path)
             msg(text, 'warn')
-            return text
+            return (text, None)
 
-        # Post it to the Microsoft cloud service.
-        if __debug__: log('Sending file to MS cloud service')
-        response = requests.post(text_recognition_url, headers = headers,
-                                 params = params, data = image_data)
+        cached = self._cached_results(data)
+        if cached is not None:
+            self._results[path] = cached
+            return (cached, None)
+
+        # Post it to the Microsoft cloud service.  If the service refuses it
+        # because we're over the rate limit, send it again after the delay
+        # the service asks for.  Transient network errors are retried by the
+        # retry policy; if they persist, only this image fails.
+        for attempt in range(_MAX_REQUEUES + 1):
+            if __debug__: log('Sending file to MS cloud service')
+            try:
+                response = self._retry.call(self._post, text_recognition_url,
+                                            headers, params, data)
+            except HTTPError as err:
+                response = err.response     # Reported below.
+                break
+            except requests.exceptions.RequestException as err:
+                return (network_error(err), None)
+            if response.status_code != 429:
+                break
+            self.rate_limited(retry_after(response) or _DEFAULT_RETRY_AFTER)
+        else:
+            text = 'MS service kept refusing "{}" due to rate limits'.format(path)
+            msg(text, 'warn')
+            return (text, None)
         try:
             response.raise_for_status()
         except HTTPError as err:
@@ -81,36 +203,106 @@ class MicrosoftHTR(HTR):
             if response.status_code in [401, 402, 403, 407, 451, 511]:
                 text = 'Authentication failure for MS service -- {}'.format(err)
                 raise ServiceFailure(text)
-            elif response.status_code == 429:
-                text = 'Server blocking further requests due to rate limits'
-                raise ServiceFailure(text)
             elif response.status_code == 503:
-                text = 'Server is unavailable -- try again later'
-                raise ServiceFailure(text)
+                return ('MS service is unavailable -- try again later', None)
             else:
-                text = 'Encountered network communications problem -- {}'.format(err) 
-                raise ServiceFailure(text)
+                return (network_error(err), None)
         except Exception as err:
-            import pdb; pdb.set_trace()
-            msg('MS rejected "{}"'.format(path), 'warn')
-            return ''
+            return ('MS rejected "{}" -- {}'.format(path, err), None)
 
-        # The Microsoft API for extracting handwritten text requires two API
-        # calls: one call to submit the image for processing, the other to
-        # retrieve the text found in the image.  We have to poll and wait
-        # until a result is available.
-        analysis = {}
-        poll = True
-        if __debug__: log('Polling MS for results ...')
-        while (poll):
-            response_final = requests.get(
-                response.headers["Operation-Location"], headers=headers)
-            analysis = response_final.json()
-            time.sleep(1)
-            if ("recognitionResult" in analysis):
-                poll = False
-            if ("status" in analysis and analysis['status'] == 'Failed'):
-                poll = False
+        location = response.headers['Operation-Location']
+        return (None, (path, data, location, retry_after(response)))
+
+
+    def _post(self, url, headers, params, data):
+        '''Posts 'data' to the service, and raises an HTTPError if the
+        response indicates a transient problem.'''
+        with self.request_slot():
+            with stage('upload', self.name()):
+                response = http_session().post(url, headers = headers,
+                                               params = params, data = data)
+        if response.status_code in RETRYABLE_STATUS:
+            response.raise_for_status()
+        return response
+
+
+    def _finish(self, operation, analysis):
+        '''Records the outcome 'analysis' of 'operation' (as returned by
+        _submit()) and returns it.'''
         if __debug__: log('Results received.')
+        (path, data, _, _) = operation
         self._results[path] = analysis
+        if 'recognitionResult' in analysis:
+            self._cache_results(data, analysis)
         return analysis
+
+
+    def _credentials_id(self):
+        return self.credentials
+
+
+    def _poll(self, location):
+        '''Checks on the recognition operation at 'location'.  Returns a tuple
+        in the form expected by OperationPoller.'''
+        headers = {'Ocp-Apim-Subscription-Key': self.credentials}
+        with self.request_slot():
+            with stage('status', self.name()):
+                response = http_session().get(location, headers = headers)
+        if response.status_code == 429:
+            # Poll again once the service is ready to take more requests.
+            delay = retry_after(response) or _DEFAULT_RETRY_AFTER
+            self.rate_limited(delay)
+            return (False, None, delay)
+        # The poller tries again after transient errors.  Any other error
+        # (such as 404 for an operation that has expired) ends the polling.
+        response.raise_for_status()
+        analysis = response.json()
+        done = ('recognitionResult' in analysis
+                or ('status' in analysis and analysis['status'] == 'Failed'))
+        return (done, analysis, retry_after(response))
+
+
+class AsyncMicrosoftHTR(AsyncHTR):
+    '''Asynchronous interface to MicrosoftHTR.  Only submitting an image
+    needs a thread; waiting for the results of the recognition operation
+    does not, so that any number of operations can be pending at once.'''
+
+    async def document_text(self, image):
+        '''Returns the pure text extracted from the image by this service.'''
+        await self.all_results(image)
+        return self._htr.document_text(image)
+
+
+    async def all_results(self, image):
+        '''Returns all the results from the service as a Python dict.'''
+        (results, operation) = await self._call(self._htr._submit, image)
+        if operation is None:
+            return results
+        (_, _, location, delay) = operation
+        try:
+            with stage('poll', self.name()):
+                analysis = await asyncio.wrap_future(
+                    self._htr._poller.poll(location, delay))
+        except requests.exceptions.RequestException as err:
+            return network_error(err)
+        except TimeoutError as err:
+            return 'MS service did not return results -- {}'.format(err)
+        return self._htr._finish(operation, analysis)
+
+
+# Helper functions.
+# -----------------------------------------------------------------------------
+
+def network_error(err):
+    '''Returns the error message for a failure to communicate with the
+    service that persisted after retrying.  It is returned in place of the
+    results, so that only the image concerned fails.'''
+    return 'Encountered network communications problem with MS service -- {}'.format(err)
+
+
+def retry_after(response):
+    '''Returns the number of seconds given in the Retry-After header of the
+    HTTP 'response', or None if there is no such header.'''
+    value = response.headers.get('Retry-After', '')
+    # The header can also hold an HTTP date, but Azure only uses seconds.
+    return int(value) if value.isdigit() else None
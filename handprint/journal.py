@@ -0,0 +1,132 @@
+'''
+journal.py: record of the progress of a run, for resuming interrupted runs.
+
+The journal is an append-only file with one JSON object per line.  Each
+line records an event for one target and one method: that work on it
+started, that it was completed, or that it failed.  When a run is resumed
+using the same journal, the targets that were completed are skipped, while
+targets that failed or that were still in progress when the run stopped are
+tried again.
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+import json
+import os
+from   os import path
+import threading
+import time
+
+import handprint
+from handprint.debug import log
+
+
+# Main class.
+# .............................................................................
+
+class Journal(object):
+    '''Append-only journal of the status of each target and method.'''
+
+    def __init__(self, journal_file):
+        self._file     = journal_file
+        self._lock     = threading.Lock()
+        self._status   = {}
+        self._errors   = {}
+        self._finished = {}             # Outcomes recorded during this run.
+        if path.exists(journal_file):
+            self._load()
+        self._stream = open(journal_file, 'a')
+        if self._stream.tell() > 0 and not _ends_with_newline(journal_file):
+            # Don't let the first new record run into an incomplete line.
+            self._stream.write('\n')
+
+
+    def completed(self, item, method):
+        '''Returns True if 'item' was completed with 'method' in this run or
+        in an earlier one.'''
+        with self._lock:
+            return self._status.get((item, method)) == 'done'
+
+
+    def started(self, item, method):
+        self._append('started', item, method)
+
+
+    def done(self, item, method, output = None):
+        self._append('done', item, method, output = output)
+
+
+    def failed(self, item, method, error):
+        self._append('failed', item, method, error = error)
+
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+
+    def summary(self):
+        '''Returns a dict mapping (item, method) tuples to the status of the
+        work done on them in this run, which is one of 'done', 'failed' or
+        'started' (if the work was interrupted).'''
+        with self._lock:
+            return dict(self._finished)
+
+
+    def errors(self):
+        '''Returns a dict mapping (item, method) tuples to the last error
+        recorded for them, for those that failed in this run.'''
+        with self._lock:
+            return {key: self._errors[key] for key, status in self._finished.items()
+                    if status == 'failed'}
+
+
+    def _append(self, status, item, method, **fields):
+        record = {'time': time.time(), 'status': status, 'item': item,
+                  'method': method}
+        record.update({k: v for k, v in fields.items() if v is not None})
+        with self._lock:
+            self._status[(item, method)] = status
+            self._finished[(item, method)] = status
+            if status == 'failed':
+                self._errors[(item, method)] = fields['error']
+            # Write each record as soon as it's made, so that as little as
+            # possible is lost if the run is interrupted.
+            self._stream.write(json.dumps(record) + '\n')
+            self._stream.flush()
+
+
+    def _load(self):
+        if __debug__: log('Reading journal {}', self._file)
+        with open(self._file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the run was killed
+                    # while writing it.
+                    continue
+                key = (record['item'], record['method'])
+                self._status[key] = record['status']
+                if record['status'] == 'failed':
+                    self._errors[key] = record.get('error', '')
+        if __debug__: log('Journal has {} entries', len(self._status))
+
+
+# Helper functions.
+# .............................................................................
+
+def _ends_with_newline(file):
+    with open(file, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
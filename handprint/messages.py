@@ -16,8 +16,6 @@ file "LICENSE" for more information.
 
 import queue
 import sys
-import wx
-import wx.lib.dialogs
 
 try:
     from termcolor import colored
@@ -128,27 +126,33 @@ class MessageHandlerCLI(MessageHandlerBase):
 class MessageHandlerGUI(MessageHandlerBase):
     '''Class for GUI-based user messages and asking the user questions.'''
 
+    # wx is only imported when an object of this class is created, because it
+    # takes a long time to import and is not needed on the command line.
+
     def __init__(self):
         super().__init__()
+        import wx
+        import wx.lib.dialogs
+        self._wx = wx
         self._queue = queue.Queue()
         self._response = None
 
 
     def info(self, text, details = ''):
         '''Prints an informational message.'''
-        wx.CallAfter(self._note, text)
+        self._wx.CallAfter(self._note, text)
         self._wait()
 
 
     def warn(self, text, details = ''):
         '''Prints a nonfatal, noncritical warning message.'''
-        wx.CallAfter(self._dialog, text, details, 'warn')
+        self._wx.CallAfter(self._dialog, text, details, 'warn')
         self._wait()
 
 
     def error(self, text, details = ''):
         '''Prints a message reporting a critical error.'''
-        wx.CallAfter(self._dialog, text, details, 'error')
+        self._wx.CallAfter(self._dialog, text, details, 'error')
         self._wait()
 
 
@@ -157,19 +161,20 @@ class MessageHandlerGUI(MessageHandlerBase):
         exit the program; it leaves that to the caller in case the caller
         needs to perform additional tasks before exiting.
         '''
-        wx.CallAfter(self._dialog, text, details, 'fatal')
+        self._wx.CallAfter(self._dialog, text, details, 'fatal')
         self._wait()
 
 
     def yes_no(self, question):
         '''Asks the user a yes/no question using a GUI dialog.'''
-        wx.CallAfter(self._yes_no, question)
+        self._wx.CallAfter(self._yes_no, question)
         self._wait()
         return self._response
 
 
     def _note(self, text):
         '''Displays a simple notice with a single OK button.'''
+        wx = self._wx
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         dlg = wx.GenericMessageDialog(frame, text, caption = "Handprint!",
@@ -181,6 +186,7 @@ class MessageHandlerGUI(MessageHandlerBase):
 
 
     def _dialog(self, text, details = '', severity = 'error'):
+        wx = self._wx
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         if 'fatal' in severity:
@@ -218,6 +224,7 @@ class MessageHandlerGUI(MessageHandlerBase):
 
 
     def _yes_no(self, question):
+        wx = self._wx
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         dlg = wx.GenericMessageDialog(frame, question, caption = "Handprint!",
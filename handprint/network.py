@@ -2,76 +2,311 @@
 network.py: miscellaneous network utilities for Holdit.
 '''
 
-import http.client
-from   http.client import responses as http_responses
-import requests
+import os
+import random
+import threading
+from   time import sleep
 
 import handprint
-from   handprint.files import rename_existing
 from   handprint.debug import log
+from   handprint.files import rename_existing
+
+
+# Connection pools.
+# .............................................................................
+# All network requests made by Handprint go through a single shared requests
+# Session, so that connections (and their TLS sessions) are kept alive and
+# reused instead of being set up anew for every request.  The Session keeps
+# a pool of connections for each host; the size of the pools determines how
+# many connections to a host can be kept open at the same time, and should
+# be at least as large as the number of threads that will use that host.
+#
+# The requests module is only imported when it's first needed, because it
+# takes a while to import and many runs of Handprint never use the network.
+
+_DEFAULT_POOL_SIZE = 10
+
+# Default timeouts, in seconds, for connecting and for reading a response.
+_DEFAULT_TIMEOUT = (10, 120)
+
+_session       = None
+_session_lock  = threading.Lock()
+_adapter_class = None
+_pool_size     = _DEFAULT_POOL_SIZE
+_host_pools    = {}
+_timeout       = _DEFAULT_TIMEOUT
+
+# Downloads whose length is known and no larger than this are read into
+# memory in one go; others are copied to disk in chunks of _CHUNK_SIZE.
+_IN_MEMORY_LIMIT = 16*1024*1024
+_CHUNK_SIZE      = 1024*1024
+
+
+def configure_pools(pool_size = None, timeout = None):
+    '''Sets the default size of the connection pool for each host and the
+    default (connect, read) timeouts in seconds.  Values that are None are
+    left unchanged.  Changing the pool size drops connections that are
+    currently idle in the default pools, so it's best done early.'''
+    global _pool_size, _timeout
+    with _session_lock:
+        if timeout is not None:
+            _timeout = timeout
+        if pool_size is not None and pool_size != _pool_size:
+            _pool_size = pool_size
+            if _session is not None:
+                _session.mount('http://', _adapter(_pool_size))
+                _session.mount('https://', _adapter(_pool_size))
+
+
+def set_host_pool_size(url_prefix, pool_size):
+    '''Sets the size of the connection pool used for URLs that start with
+    'url_prefix', which should be of the form "https://host/".  A pool that
+    is already larger is left as it is.'''
+    with _session_lock:
+        if _host_pools.get(url_prefix, 0) >= pool_size:
+            return
+        _host_pools[url_prefix] = pool_size
+        if _session is not None:
+            _session.mount(url_prefix, _adapter(pool_size))
+
+
+def http_session():
+    '''Returns the shared requests Session object.  The Session is safe to
+    use from multiple threads as long as its settings are not modified.'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            if __debug__: log('Creating HTTP session with pool size {}', _pool_size)
+            import requests
+            _session = requests.Session()
+            _session.mount('http://', _adapter(_pool_size))
+            _session.mount('https://', _adapter(_pool_size))
+            for (url_prefix, pool_size) in _host_pools.items():
+                _session.mount(url_prefix, _adapter(pool_size))
+        return _session
+
+
+def _adapter(pool_size):
+    global _adapter_class
+    if _adapter_class is None:
+        from requests.adapters import HTTPAdapter
+
+        class PoolAdapter(HTTPAdapter):
+            '''HTTPAdapter that applies Handprint's default timeouts to
+            requests that don't give their own.'''
+
+            def send(self, request, **kwargs):
+                if kwargs.get('timeout') is None:
+                    kwargs['timeout'] = _timeout
+                return super().send(request, **kwargs)
+
+        _adapter_class = PoolAdapter
+    return _adapter_class(pool_connections = pool_size, pool_maxsize = pool_size)
+
+
+# Retries.
+# .............................................................................
+# Transient failures, such as a connection being reset or a server being
+# briefly unavailable, are retried after a delay that grows exponentially
+# with each attempt.  The delays are partly random, so that many workers
+# that fail at the same moment don't all retry at the same moment too.
+
+# HTTP status codes that indicate a problem that may go away by itself.
+RETRYABLE_STATUS = (500, 502, 503, 504)
+
+class RetryPolicy(object):
+    '''Policy for retrying operations that fail with transient errors.
+
+    'retryable' is a function that takes an exception and returns True if
+    it represents a transient error.  An operation is tried at most
+    'attempts' times in all.  The delay before the n-th retry is between
+    half and all of 'first_delay' * 2^(n-1) seconds, but no more than
+    'max_delay' seconds.
+    '''
+
+    def __init__(self, retryable, attempts = 4, first_delay = 1, max_delay = 30):
+        self.retryable   = retryable
+        self.attempts    = attempts
+        self.first_delay = first_delay
+        self.max_delay   = max_delay
+
+
+    def retry(self, err, attempt):
+        '''Returns True if an operation that failed with the exception 'err'
+        on its 'attempt'-th attempt should be tried again.'''
+        return attempt < self.attempts and self.retryable(err)
+
+
+    def delay(self, attempt):
+        '''Returns the number of seconds to wait after the 'attempt'-th
+        attempt failed, before trying again.'''
+        ceiling = min(self.max_delay, self.first_delay * 2 ** (attempt - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+
+    def call(self, func, *args, **kwargs):
+        '''Returns func(*args, **kwargs), calling it again as long as it
+        raises exceptions that the policy says to retry.'''
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if not self.retry(err, attempt):
+                    raise
+                delay = self.delay(attempt)
+                if __debug__: log('Retrying in {:.1f}s after error: {}', delay, err)
+                sleep(delay)
+                attempt += 1
+
+
+def transient_http_error(err):
+    '''Returns True if 'err', an exception raised by the requests module,
+    represents an error that may go away if the request is made again.'''
+    import requests
+    if isinstance(err, requests.exceptions.HTTPError):
+        return err.response is not None and err.response.status_code in RETRYABLE_STATUS
+    if isinstance(err, requests.exceptions.SSLError):
+        return False
+    return isinstance(err, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                            requests.exceptions.ChunkedEncodingError))
+
+
+_retry = RetryPolicy(transient_http_error)
+
+
+# Main functions.
+# .............................................................................
 
 
 def network_available():
     '''Return True if it appears we have a network connection, False if not.'''
+    import requests
     try:
-        r = requests.get("https://www.caltech.edu")
+        r = http_session().get("https://www.caltech.edu")
         return True
     except requests.ConnectionError:
         if __debug__: log('Could not connect to https://www.caltech.edu')
         return False
 
 
-def download_url(url, local_destination):
-    '''Download the 'url' to the file 'local_destination' and return a tuple
-    of (success, error) indicating whether the attempt succeeded and an error
-    message if it failed.
+def download_image(url, dest_root, formats):
+    '''Download the image at 'url' using a single request.  The type of
+    the content is checked before the body is read: it must be an image in
+    one of the given 'formats' (e.g., "jpeg").  The image is written to a
+    file named 'dest_root' plus an extension for the format.  Returns a
+    tuple of (success, file, data, error), where 'data' is the content of
+    the image if it was small enough to be kept in memory, or else None.
+    Transient network errors are retried.
     '''
+    try:
+        return _retry.call(_download_image, url, dest_root, formats)
+    except Exception as err:
+        return (False, None, None, _error_message(err))
+
+
+# Helper functions.
+# .............................................................................
 
-    # Attempt to do the download.
+def _download_image(url, dest_root, formats):
+    req = _request(url)
     try:
+        content_type = req.headers.get('Content-Type', '').split(';')[0]
+        (maintype, _, fmt) = content_type.strip().lower().partition('/')
+        if maintype != 'image':
+            return (False, None, None, 'Did not find an image at "{}"'.format(url))
+        if fmt not in formats:
+            return (False, None, None,
+                    'Cannot use image format {} in "{}"'.format(fmt, url))
+        file = dest_root + '.' + fmt
+        if __debug__: log('Writing downloaded image to {}', file)
+        data = _save_body(req, file)
+        return (True, file, data, '')
+    finally:
+        req.close()
+
+
+def _request(url):
+    '''Starts a GET request for 'url' without reading the body of the
+    response, and returns the response.  Raises an exception if there was
+    an error, including an HTTPError if the response has an error status.'''
+    import requests
+    while True:
         if __debug__: log('Requesting {}', url)
-        req = requests.get(url, stream = True)
-    except requests.exceptions.ConnectionError as err:
+        req = http_session().get(url, stream = True)
+
+        # Interpret the response.
+        code = req.status_code
+        if code == 202:
+            # Code 202 = Accepted, "received but not yet acted upon."
+            if __debug__: log('Pausing & retrying')
+            req.close()
+            sleep(1)                    # Sleep a short time and try again.
+            continue
+        elif 200 <= code < 400:
+            return req
+        req.close()
+        req.raise_for_status()
+        raise requests.exceptions.HTTPError('Status {}'.format(code), response = req)
+
+
+def _error_message(err):
+    '''Returns an error message for the exception 'err' raised while trying
+    to download something.'''
+    import requests
+    import urllib3
+    if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        return _status_error(err.response.status_code)
+    if isinstance(err, requests.exceptions.ConnectionError):
         if err.args and isinstance(err.args[0], urllib3.exceptions.MaxRetryError):
-            return (False, 'Unable to resolve destination host')
-        else:
-            return (False, str(err))
-    except requests.exceptions.InvalidSchema as err:
-        return (False, 'Unsupported network protocol')
-    except Exceptions as err:
-        return (False, str(err))
-
-    # Interpret the response.
-    code = req.status_code
-    if code == 202:
-        # Code 202 = Accepted, "received but not yet acted upon."
-        if __debug__: log('Pausing & retrying')
-        sleep(1)                        # Sleep a short time and try again.
-        return download_url(url, local_destination)
-    elif 200 <= code < 400:
-        if __debug__: log('Writing downloaded data to {}', local_destination)
-        rename_existing(local_destination)
-        # The following originally started out as the code here:
-        # https://stackoverflow.com/a/16696317/743730
-        with open(local_destination, 'wb') as f:
-            for chunk in req.iter_content(chunk_size = 1024):
-                if chunk:
+            return 'Unable to resolve destination host'
+    if isinstance(err, requests.exceptions.InvalidSchema):
+        return 'Unsupported network protocol'
+    return str(err)
+
+
+def _save_body(req, file):
+    '''Writes the body of the response 'req' to 'file'.  Small bodies are
+    read in one go; large ones are copied in large chunks, so that little
+    time is spent in Python code per byte.  The data goes to a temporary
+    file first, so that 'file' is never left incomplete.  Returns the body
+    if it was read into memory, or None if it was copied in chunks.'''
+    rename_existing(file)
+    tmp_file = '{}.{}.tmp'.format(file, threading.get_ident())
+    length = req.headers.get('Content-Length', '')
+    data = None
+    try:
+        with open(tmp_file, 'wb') as f:
+            if length.isdigit() and int(length) <= _IN_MEMORY_LIMIT:
+                data = req.content
+                f.write(data)
+            else:
+                for chunk in req.iter_content(chunk_size = _CHUNK_SIZE):
                     f.write(chunk)
-        req.close()
-        return (True, '')
-    elif code in [401, 402, 403, 407, 451, 511]:
-        return (False, "Access is forbidden or requires authentication")
+    except Exception:
+        # E.g., the connection was lost; the download may be retried.
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, file)
+    return data
+
+
+def _status_error(code):
+    '''Returns an error message for the unsuccessful HTTP status 'code'.'''
+    if code in [401, 402, 403, 407, 451, 511]:
+        return "Access is forbidden or requires authentication"
     elif code in [404, 410]:
-        return (False, "No content found at this location")
+        return "No content found at this location"
     elif code in [405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510]:
-        return (False, "Server returned code {} -- please report this".format(code))
+        return "Server returned code {} -- please report this".format(code)
     elif code in [415, 416]:
-        return (False, "Server rejected the request")
+        return "Server rejected the request"
     elif code == 429:
-        return (False, "Server blocking further requests due to rate limits")
+        return "Server blocking further requests due to rate limits"
     elif code == 503:
-        return (False, "Server is unavailable -- try again later")
+        return "Server is unavailable -- try again later"
     elif code in [500, 501, 502, 506, 507, 508]:
-        return (False, "Internal server error")
+        return "Internal server error"
     else:
-        return (False, "Unable to resolve URL")
+        return "Unable to resolve URL"
@@ -0,0 +1,223 @@
+'''
+profiling.py: profile a run of Handprint.
+
+A Profiler combines two kinds of profiles of the same run:
+
+ * a deterministic profile made with cProfile, which is written in the
+   pstats format (for use with Python's pstats module, snakeviz, etc.);
+
+ * a sampling profile made by looking at the stacks of the threads at
+   regular intervals, which is written as "collapsed stacks" (one line per
+   distinct stack, with the number of times it was seen), the format used
+   by flame graph tools such as flamegraph.pl and speedscope.
+
+cProfile only profiles the thread in which it is started, so the thread pools
+used by the engine call profile_thread() when they start each thread.  The
+profile can include all threads, or only the first worker thread, so that
+the hot spots of the work on an image can be found while disturbing the rest
+of a run as little as possible.  From Python 3.12 on, cProfile uses
+sys.monitoring, which permits only one active profiler but sees all threads;
+there, the profile started for the first thread is the only one, and it
+covers the whole process.  Image conversions are done in separate
+processes; call_profiled() profiles them there and brings back the results,
+which are included in the pstats output (but not in the collapsed stacks).
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+from   collections import Counter
+import cProfile
+from   os import path
+import pstats
+import sys
+import threading
+import time
+
+import handprint
+from handprint.debug import log
+
+
+# Constants.
+# .............................................................................
+
+# Seconds between samples of the thread stacks.
+_SAMPLE_INTERVAL = 0.005
+
+# Whether cProfile can profile more than one thread at a time.
+_PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+
+# Global state.
+# .............................................................................
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    '''Sets the Profiler used by profile_thread() and call_profiled().'''
+    global _profiler
+    _profiler = profiler
+
+
+def profiler():
+    '''Returns the current Profiler, or None if there isn't one.'''
+    return _profiler
+
+
+def profile_thread():
+    '''Starts profiling the calling thread, if there is a Profiler and it
+    is profiling threads started now.  For use as the initializer of
+    thread pools.'''
+    if _profiler:
+        _profiler.add_thread()
+
+
+def call_profiled(func, *args):
+    '''Calls func(*args) under cProfile and returns a tuple of (result,
+    profile data).  The profile data can be given to Profiler.add_stats().
+    This is meant to be run in a separate process.'''
+    profile = cProfile.Profile()
+    result = profile.runcall(func, *args)
+    profile.create_stats()
+    return (result, profile.stats)
+
+
+# Main class.
+# .............................................................................
+
+class Profiler(object):
+    '''Profiles the main thread (if 'main_thread' is True) and the threads
+    that call add_thread().  If 'one_worker' is True, only the first of
+    them is profiled, which is the main thread if 'main_thread' is True.'''
+
+    def __init__(self, one_worker = False, main_thread = True):
+        self._one_worker  = one_worker
+        self._main_thread = main_thread
+        self._lock        = threading.Lock()
+        self._profiles    = []
+        self._extra       = []
+        self._threads     = set()
+        self._samples     = Counter()
+        self._sampling    = False
+        self._sampler     = None
+
+
+    def start(self):
+        '''Starts profiling.'''
+        if __debug__: log('Starting profiler')
+        if self._main_thread:
+            self.add_thread()
+        self._sampling = True
+        self._sampler = threading.Thread(target = self._sample, daemon = True,
+                                         name = 'profile sampler')
+        self._sampler.start()
+
+
+    def add_thread(self):
+        '''Starts profiling the calling thread.  It stays profiled until it
+        ends or stop() is called.'''
+        with self._lock:
+            if self._one_worker and self._threads:
+                return
+            if threading.get_ident() in self._threads:
+                return
+            self._threads.add(threading.get_ident())
+            if self._profiles and not _PROFILE_PER_THREAD:
+                if __debug__: log('Sampling thread {}', threading.current_thread().name)
+                return
+            profile = cProfile.Profile()
+            self._profiles.append(profile)
+        if __debug__: log('Profiling thread {}', threading.current_thread().name)
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active (e.g., one started by the
+            # user with python -m cProfile); leave this thread to the sampler.
+            with self._lock:
+                self._profiles.remove(profile)
+
+
+    def add_stats(self, stats):
+        '''Adds profile data returned by call_profiled().'''
+        with self._lock:
+            self._extra.append(stats)
+
+
+    def stop(self):
+        '''Stops profiling.  Threads other than the calling one should have
+        ended or be idle by then.'''
+        self._sampling = False
+        if self._sampler:
+            self._sampler.join()
+        with self._lock:
+            for profile in self._profiles:
+                profile.create_stats()
+
+
+    def write(self, base_name):
+        '''Writes the results into the files 'base_name' + ".pstats" and
+        'base_name' + ".collapsed", and returns a list of their paths.'''
+        stats = None
+        with self._lock:
+            for source in self._profiles + [_Stats(s) for s in self._extra]:
+                if stats is None:
+                    stats = pstats.Stats(source)
+                else:
+                    stats.add(source)
+        pstats_file = base_name + '.pstats'
+        if stats:
+            stats.dump_stats(pstats_file)
+        collapsed_file = base_name + '.collapsed'
+        with open(collapsed_file, 'w', encoding = 'utf-8') as f:
+            for (stack, count) in sorted(self._samples.items()):
+                f.write('{} {}\n'.format(stack, count))
+        return [pstats_file, collapsed_file] if stats else [collapsed_file]
+
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while self._sampling:
+            time.sleep(_SAMPLE_INTERVAL)
+            threads = self._threads if self._one_worker else None
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me or (threads is not None and ident not in threads):
+                    continue
+                if ident not in names:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                self._samples[_collapse(names.get(ident, str(ident)), frame)] += 1
+
+
+# Helper functions.
+# .............................................................................
+
+class _Stats(object):
+    # pstats.Stats() accepts any object with these, as it does Profile objects.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _collapse(thread_name, frame):
+    '''Returns the stack of 'frame' in collapsed-stack form, starting with
+    'thread_name'.'''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, path.basename(code.co_filename),
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
@@ -14,12 +14,8 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from   halo import Halo
-from   pubsub import pub
 import sys
 import time
-import wx
-import wx.lib.dialogs
 
 try:
     from termcolor import colored
@@ -48,6 +44,8 @@ class ProgressIndicator():
         if message is None:
             message = ''
         if self._colorize:
+            # Halo is imported here because it is slow to import.
+            from halo import Halo
             text = color(message, 'info')
             self._spinner = Halo(spinner='bouncingBall', text = text)
             self._spinner.start()
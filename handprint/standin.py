@@ -0,0 +1,280 @@
+'''
+standin.py: local stand-in for the network services used by Handprint.
+
+This runs servers that speak the same protocols as the Microsoft and Google
+services, so that Handprint can be run (and its throughput and handling of
+failures measured) without network access, credentials or charges:
+
+ * an HTTP server emulating Microsoft's recognizeText API: images are
+   POSTed to .../recognizeText, which returns an Operation-Location header
+   that is then polled until the recognition operation has "Succeeded";
+
+ * a gRPC server emulating the BatchAnnotateImages call of Google's Cloud
+   Vision API (version v1p3beta1, as used by handprint.htr.google).
+
+The time each operation takes, the fraction of requests that fail with a
+transient error, and the number of requests per second that are accepted
+before requests are refused because of rate limits can all be set.  The
+results always contain the same text.  Start it with
+
+  python3 -m handprint.standin
+
+and then run Handprint with the option -e, using the endpoints printed.
+The Google stand-in needs the grpcio and google-cloud-vision packages; if
+they are not installed, only the Microsoft stand-in is started.
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import plac
+import random
+import threading
+import time
+import uuid
+
+import handprint
+
+
+# Constants.
+# .............................................................................
+
+_MS_PATH = '/vision/v2.0/'
+
+_GOOGLE_SERVICE = 'google.cloud.vision.v1p3beta1.ImageAnnotator'
+
+# How long clients are told to wait when refused because of rate limits.
+_RETRY_AFTER = 1
+
+_DEFAULT_TEXT = 'Handprint stand-in service result'
+
+
+# Main program.
+# .............................................................................
+
+@plac.annotations(
+    ms_port     = ('serve the Microsoft API on port "M" (default: 8090)',   'option', 'm', int),
+    google_port = ('serve the Google API on port "G" (default: 50051)',     'option', 'g', int),
+    latency     = ('take "L" seconds on average per image (default: 1)',    'option', 'l', float),
+    errors      = ('fail fraction "E" of requests (default: 0)',            'option', 'e', float),
+    quota       = ('accept "Q" requests/second at most (default: no limit)', 'option', 'q', float),
+    text        = ('return text "T" for every image',                       'option', 't'),
+)
+
+def main(ms_port = 8090, google_port = 50051, latency = 1.0, errors = 0.0,
+         quota = None, text = _DEFAULT_TEXT):
+    '''Runs stand-ins for the Microsoft and Google services until
+interrupted.  Each image takes -l seconds on average to be recognized (the
+actual time varies randomly between half and one and a half times that).  A
+fraction -e of all requests fail with a transient error (HTTP status 503 or
+gRPC status UNAVAILABLE).  If -q is given, each service accepts at most that
+many requests per second, and refuses the others as the real services do
+(with HTTP status 429 or gRPC status RESOURCE_EXHAUSTED).
+'''
+    behavior = Behavior(latency, errors, quota, text)
+    ms_server = microsoft_server(ms_port, behavior)
+    threading.Thread(target = ms_server.serve_forever, daemon = True).start()
+    print('Microsoft stand-in: microsoft=http://localhost:{}{}'.format(ms_port, _MS_PATH))
+    try:
+        google_server = grpc_server(google_port, behavior)
+        google_server.start()
+        print('Google stand-in:    google=localhost:{}'.format(google_port))
+    except ImportError:
+        google_server = None
+        print('Google client libraries not installed; not emulating Google.')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ms_server.shutdown()
+        if google_server:
+            google_server.stop(0)
+
+
+# Behavior shared by the servers.
+# .............................................................................
+
+class Behavior(object):
+    '''How the stand-in services behave: how long operations take, how
+    often requests fail, and how many requests are accepted per second.
+    Each service has its own quota.'''
+
+    def __init__(self, latency, errors, quota, text):
+        self.latency = latency
+        self.errors  = errors
+        self.quota   = quota
+        self.text    = text
+        self._lock   = threading.Lock()
+        self._counts = {}
+
+
+    def duration(self):
+        '''Returns how long an operation should take, in seconds.'''
+        return self.latency * random.uniform(0.5, 1.5)
+
+
+    def fail(self):
+        '''Returns True if a request should fail with a transient error.'''
+        return random.random() < self.errors
+
+
+    def over_quota(self, service):
+        '''Records a request to 'service' and returns True if it exceeds the
+        number of requests permitted in the current second.'''
+        if not self.quota:
+            return False
+        second = int(time.time())
+        with self._lock:
+            (start, count) = self._counts.get(service, (second, 0))
+            if start != second:
+                (start, count) = (second, 0)
+            self._counts[service] = (start, count + 1)
+            return count + 1 > self.quota
+
+
+# Microsoft.
+# .............................................................................
+
+def microsoft_server(port, behavior):
+    '''Returns an HTTP server emulating the Microsoft recognizeText API on
+    'port'.  The caller has to start it.'''
+    operations = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if self.path.split('?')[0] != _MS_PATH + 'recognizeText':
+                return self._reply(404, {'error': 'Not found'})
+            if self._refused():
+                return
+            if not body:
+                return self._reply(400, {'error': 'No image data'})
+            id = str(uuid.uuid4())
+            with lock:
+                operations[id] = time.time() + behavior.duration()
+            location = 'http://{}{}textOperations/{}'.format(
+                self.headers.get('Host', 'localhost'), _MS_PATH, id)
+            self._reply(202, None, {'Operation-Location': location})
+
+
+        def do_GET(self):
+            id = self.path.split('?')[0].rpartition('/textOperations/')[2]
+            with lock:
+                deadline = operations.get(id)
+            if deadline is None:
+                return self._reply(404, {'error': 'Unknown operation'})
+            if self._refused():
+                return
+            if time.time() < deadline:
+                return self._reply(200, {'status': 'Running'})
+            with lock:
+                operations.pop(id, None)
+            self._reply(200, {'status': 'Succeeded',
+                              'recognitionResult': {'lines': ms_lines(behavior.text)}})
+
+
+        def _refused(self):
+            if behavior.over_quota('microsoft'):
+                self._reply(429, {'error': 'Rate limit exceeded'},
+                            {'Retry-After': str(_RETRY_AFTER)})
+                return True
+            if behavior.fail():
+                self._reply(503, {'error': 'Service unavailable'})
+                return True
+            return False
+
+
+        def _reply(self, status, content, headers = {}):
+            body = json.dumps(content).encode('utf-8') if content is not None else b''
+            self.send_response(status)
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def ms_lines(text):
+    '''Returns the "lines" of a recognitionResult containing 'text'.'''
+    lines = []
+    for (n, line) in enumerate(text.splitlines() or ['']):
+        top = 100 * n
+        words = [{'boundingBox': [0, top, 10, top, 10, top + 50, 0, top + 50],
+                  'text': word} for word in line.split()]
+        lines.append({'boundingBox': [0, top, 1000, top, 1000, top + 50, 0, top + 50],
+                      'text': line, 'words': words})
+    return lines
+
+
+# Google.
+# .............................................................................
+
+def grpc_server(port, behavior):
+    '''Returns a gRPC server emulating the Google Cloud Vision API call
+    BatchAnnotateImages on 'port'.  The caller has to start it.  Raises
+    ImportError if the Google client libraries are not installed.'''
+    from concurrent.futures import ThreadPoolExecutor
+    import grpc
+    from google.cloud import vision_v1p3beta1 as gv
+
+    text_features = (gv.enums.Feature.Type.TEXT_DETECTION,
+                     gv.enums.Feature.Type.DOCUMENT_TEXT_DETECTION)
+
+    def annotate(request, context):
+        if behavior.over_quota('google'):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Quota exceeded')
+        if behavior.fail():
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'Service unavailable')
+        time.sleep(behavior.duration())
+        responses = []
+        for image_request in request.requests:
+            response = gv.types.AnnotateImageResponse()
+            if any(f.type in text_features for f in image_request.features):
+                response.full_text_annotation.text = behavior.text
+                response.text_annotations.add(description = behavior.text, locale = 'en')
+            responses.append(response)
+        return gv.types.BatchAnnotateImagesResponse(responses = responses)
+
+    handler = grpc.method_handlers_generic_handler(_GOOGLE_SERVICE, {
+        'BatchAnnotateImages': grpc.unary_unary_rpc_method_handler(
+            annotate,
+            request_deserializer = gv.types.BatchAnnotateImagesRequest.FromString,
+            response_serializer = gv.types.BatchAnnotateImagesResponse.SerializeToString)
+    })
+    server = grpc.server(ThreadPoolExecutor(max_workers = 32))
+    server.add_generic_rpc_handlers((handler,))
+    server.add_insecure_port('localhost:{}'.format(port))
+    return server
+
+
+# Main entry point.
+# .............................................................................
+
+if __name__ == '__main__':
+    plac.call(main)
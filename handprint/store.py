@@ -0,0 +1,213 @@
+'''
+store.py: store of results kept in a single database file.
+
+Normally, Handprint writes two files for each image and each method: the
+text and all the results.  For very large numbers of images, this means
+very many small files, which can be slow to write on network file systems.
+A ResultStore keeps the same contents in one SQLite database instead,
+indexed by target and method.  The results are written in batches, each in
+a single transaction, rather than one at a time.  The files that would have
+been written are recorded with the results, and can be produced from the
+database at any time by running
+
+  python3 -m handprint.store DATABASE
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+import os
+from   os import path
+import plac
+import sqlite3
+import threading
+import time
+
+import handprint
+from handprint.debug import log
+from handprint.constants import COMPRESSION_FORMATS
+from handprint.files import save_output, save_data
+
+
+# Constants.
+# .............................................................................
+
+# Results are committed when this many are waiting, or when the oldest has
+# been waiting this many seconds.
+
+_BATCH_SIZE    = 200
+_BATCH_SECONDS = 5
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    target    TEXT NOT NULL,
+    method    TEXT NOT NULL,
+    text_file TEXT NOT NULL,
+    json_file TEXT NOT NULL,
+    text      TEXT NOT NULL,
+    results   TEXT NOT NULL,
+    time      REAL NOT NULL,
+    PRIMARY KEY (target, method)
+)
+'''
+
+
+# Main class.
+# .............................................................................
+
+class ResultStore(object):
+    '''Database of the results of applying methods to targets.'''
+
+    def __init__(self, db_file, batch_size = _BATCH_SIZE,
+                 batch_seconds = _BATCH_SECONDS):
+        self._file          = db_file
+        self._batch_size    = batch_size
+        self._batch_seconds = batch_seconds
+        self._lock          = threading.Lock()
+        self._pending       = {}
+        self._oldest        = None
+        if __debug__: log('Opening result store {}', db_file)
+        self._db = sqlite3.connect(db_file, check_same_thread = False)
+        # Write-ahead logging makes commits much cheaper, and a commit that
+        # is lost in a crash is only a batch of results to redo.
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+
+    def add(self, target, method, text_file, json_file, text, results):
+        '''Adds the 'text' and 'results' (as a JSON string) obtained by
+        applying 'method' to 'target', replacing any earlier ones.  The
+        names 'text_file' and 'json_file' are where they would have been
+        written as files.'''
+        with self._lock:
+            self._pending[(target, method)] = (target, method, text_file, json_file,
+                                               text, results, time.time())
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if (len(self._pending) >= self._batch_size
+                    or time.monotonic() - self._oldest >= self._batch_seconds):
+                self._commit()
+
+
+    def contains(self, target, method):
+        '''Returns True if there are results for 'target' and 'method'.'''
+        with self._lock:
+            if (target, method) in self._pending:
+                return True
+            row = self._db.execute('SELECT 1 FROM results WHERE target = ? AND method = ?',
+                                   (target, method)).fetchone()
+            return row is not None
+
+
+    def flush(self):
+        '''Commits the results that are waiting to be written.'''
+        with self._lock:
+            self._commit()
+
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+
+    def rows(self):
+        '''Yields a tuple of (target, method, text file, JSON file, text,
+        results) for each of the stored results.'''
+        self.flush()
+        cursor = self._db.execute('SELECT target, method, text_file, json_file, text,'
+                                  ' results FROM results ORDER BY target, method')
+        for row in cursor:
+            yield row
+
+
+    def export(self, dest_dir = None, compression = None):
+        '''Writes the stored results into the files they would have been
+        written to without the store, or if 'dest_dir' is given, into
+        'dest_dir'.  In the latter case, the files keep their paths relative
+        to the directory that contains all of them, so that files with the
+        same name in different directories remain distinct.  The JSON files
+        are compressed using 'compression' if it's not None, as
+        files.save_json() does.  Returns the number of results.'''
+        if dest_dir:
+            root = self._common_dir()
+        count = 0
+        for (_, _, text_file, json_file, text, results) in self.rows():
+            if dest_dir:
+                text_file = path.join(dest_dir, path.relpath(text_file, root))
+                json_file = path.join(dest_dir, path.relpath(json_file, root))
+            os.makedirs(path.dirname(text_file), exist_ok = True)
+            os.makedirs(path.dirname(json_file), exist_ok = True)
+            if compression:
+                json_file += COMPRESSION_FORMATS[compression]
+            save_output(text, text_file)
+            save_data(results.encode('utf-8'), json_file, compression)
+            count += 1
+        return count
+
+
+    def _common_dir(self):
+        '''Returns the deepest directory containing all the stored files.'''
+        self.flush()
+        cursor = self._db.execute('SELECT text_file, json_file FROM results')
+        dirs = set(path.dirname(file) for row in cursor for file in row)
+        return path.commonpath(list(dirs)) if dirs else ''
+
+
+    def _commit(self):
+        if not self._pending:
+            return
+        if __debug__: log('Committing {} results to {}', len(self._pending), self._file)
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 list(self._pending.values()))
+        self._pending = {}
+        self._oldest = None
+
+
+# Export command.
+# .............................................................................
+
+@plac.annotations(
+    output   = ('write the files to directory "O"',                 'option', 'o'),
+    compress = ('compress JSON files with "Z" ("gzip" or "zstd")',  'option', 'z'),
+    database = 'result store written by Handprint with the option -b',
+)
+
+def main(output = 'O', compress = 'Z', database = None):
+    '''Writes the results kept in a result store into the text and JSON files
+that Handprint would have written without the store.  By default, the files
+are written where Handprint would have written them; if given the -o
+option, they are written to the directory given instead, in subdirectories
+if the targets were in different directories.  If given the -z
+option, the JSON files are compressed in the same way as by Handprint's -z
+option.
+'''
+    if not database or not path.exists(database):
+        raise SystemExit('Result store not found: {}'.format(database))
+    output = None if output == 'O' else output
+    compress = None if compress == 'Z' else compress
+    if compress and compress not in COMPRESSION_FORMATS:
+        raise SystemExit('Unknown compression format: {}'.format(compress))
+    if output:
+        os.makedirs(output, exist_ok = True)
+    store = ResultStore(database)
+    try:
+        print('Wrote {} results.'.format(store.export(output, compress)))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -0,0 +1,261 @@
+'''
+timing.py: measure how long each stage of processing takes.
+
+The stages of the work on each target (downloading it, converting it,
+sending it to a service, waiting for the results, writing the outputs, and
+so on) are timed by wrapping them in "with stage(name):".  The measurements
+are given to the recorders added with add_recorder().  A Recorder writes a
+machine-readable record for each target as soon as the target is finished,
+and can produce a summary of the whole run with percentiles of the
+durations of each stage.  A TraceRecorder writes every stage as an event in
+the Trace Event Format, so that a run can be viewed on a timeline in tools
+such as chrome://tracing or Perfetto.  When there are no recorders,
+stage() does nothing.
+
+The target that a measurement belongs to is taken from the context in which
+the stage runs, so that code deep inside the HTR methods doesn't need to be
+told which target it is working on.  The engine sets it using working_on().
+Functions run in other threads have to be wrapped using bind() to carry the
+context with them.
+
+Authors
+-------
+
+Handprint contributors
+
+Copyright
+---------
+
+Copyright (c) 2026 by the Handprint contributors.  This code is open-source
+software released under a 3-clause BSD license.  Please see the file
+"LICENSE" for more information.
+'''
+
+from   collections import defaultdict
+from   contextlib import contextmanager
+import contextvars
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import handprint
+from handprint.debug import log
+
+
+# Global state.
+# .............................................................................
+
+_recorders = ()
+
+_target = contextvars.ContextVar('handprint_target', default = None)
+
+
+def add_recorder(recorder):
+    '''Adds 'recorder' to the recorders that receive the measurements.'''
+    global _recorders
+    _recorders = _recorders + (recorder,)
+
+
+def remove_recorder(recorder):
+    '''Stops giving measurements to 'recorder'.'''
+    global _recorders
+    _recorders = tuple(r for r in _recorders if r is not recorder)
+
+
+def finished(item):
+    '''Tells the recorders that the work on target 'item' is finished.'''
+    for recorder in _recorders:
+        recorder.finish(item)
+
+
+@contextmanager
+def working_on(item):
+    '''Attributes the stages run within the "with" block to target 'item'.'''
+    token = _target.set(item)
+    try:
+        yield
+    finally:
+        _target.reset(token)
+
+
+@contextmanager
+def stage(name, service = None):
+    '''Measures the time taken by the "with" block as stage 'name' of the
+    work on the current target, done for 'service' (if not None).'''
+    if not _recorders:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        for recorder in _recorders:
+            recorder.record(_target.get(), name, service, start, end)
+
+
+def bind(func):
+    '''Returns a function that calls 'func' in the current context, for
+    running 'func' in another thread.'''
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+# Recorders.
+# .............................................................................
+
+class Recorder(object):
+    '''Collects the durations of stages.  The measurements for each target
+    are written to 'file' as a line of JSON when finish() is called for the
+    target.  Times in the records are in seconds, and the start of a stage
+    is given relative to the creation of the Recorder.'''
+
+    def __init__(self, file):
+        self._file      = open(file, 'w', encoding = 'utf-8')
+        self._lock      = threading.Lock()
+        self._origin    = time.perf_counter()
+        self._pending   = defaultdict(list)
+        self._durations = defaultdict(list)
+        self._finished  = 0
+
+
+    def record(self, item, name, service, start, end):
+        '''Records that stage 'name' of the work on target 'item' took from
+        'start' to 'end' (values of time.perf_counter()).'''
+        with self._lock:
+            self._durations[(name, service)].append(end - start)
+            # Stages not done for a particular target only go in the summary.
+            if item is not None:
+                self._pending[item].append((name, service, start, end))
+
+
+    def finish(self, item):
+        '''Writes the record of the stages of the work on target 'item'.'''
+        with self._lock:
+            spans = self._pending.pop(item, [])
+            if not spans:
+                return
+            self._finished += 1
+            record = {'target': item,
+                      'start': round(min(s[2] for s in spans) - self._origin, 6),
+                      'end': round(max(s[3] for s in spans) - self._origin, 6),
+                      'stages': [{'stage': name, 'service': service,
+                                  'start': round(start - self._origin, 6),
+                                  'seconds': round(end - start, 6)}
+                                 for (name, service, start, end) in spans]}
+            self._file.write(json.dumps(record) + '\n')
+
+
+    def summary(self):
+        '''Returns a list of dicts summarizing the durations of each stage for
+        each service: the number of times the stage was done, the total time
+        taken, the 50th, 95th and 99th percentiles of the time taken, and
+        the throughput (the number of times per second of the whole run).'''
+        elapsed = time.perf_counter() - self._origin
+        with self._lock:
+            durations = dict(self._durations)
+        summary = []
+        for ((name, service), times) in sorted(durations.items(),
+                                               key = lambda x: (x[0][0], x[0][1] or '')):
+            times = sorted(times)
+            summary.append({'stage': name, 'service': service, 'count': len(times),
+                            'total': round(sum(times), 6),
+                            'p50': round(percentile(times, 50), 6),
+                            'p95': round(percentile(times, 95), 6),
+                            'p99': round(percentile(times, 99), 6),
+                            'throughput': round(len(times) / elapsed, 3)})
+        return summary
+
+
+    def close(self):
+        '''Writes the records of unfinished targets and the summary, and
+        returns the summary.  The summary is written as a last line of the
+        form {"summary": ..., "targets": N, "seconds": S}, where N is the
+        number of targets recorded and S the time since the Recorder was
+        created.'''
+        for item in list(self._pending.keys()):
+            self.finish(item)
+        summary = self.summary()
+        with self._lock:
+            if __debug__: log('Writing timing summary to {}', self._file.name)
+            elapsed = round(time.perf_counter() - self._origin, 6)
+            self._file.write(json.dumps({'summary': summary, 'targets': self._finished,
+                                         'seconds': elapsed}) + '\n')
+            self._file.close()
+        return summary
+
+
+class TraceRecorder(object):
+    '''Writes each stage to 'file' as a "complete" event of the Trace Event
+    Format.  Each thread gets a track of its own, named after the thread.
+    Stages run by asyncio tasks overlap in the thread of the event loop, so
+    they are put on a separate track for each target instead.  The file is
+    written as the events happen and is completed by close().'''
+
+    def __init__(self, file):
+        self._file   = open(file, 'w', encoding = 'utf-8')
+        self._lock   = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid    = os.getpid()
+        self._tracks = {}
+        self._file.write('[\n')
+
+
+    def record(self, item, name, service, start, end):
+        '''Writes an event for stage 'name' of the work on target 'item',
+        which took from 'start' to 'end' (values of time.perf_counter()).'''
+        event = {'name': name if service is None else '{} {}'.format(service, name),
+                 'cat': service or 'handprint', 'ph': 'X', 'pid': self._pid,
+                 'ts': round((start - self._origin) * 1e6, 1),
+                 'dur': round((end - start) * 1e6, 1),
+                 'args': {'target': item}}
+        if item is not None and _in_event_loop():
+            track = 'target {}'.format(item)
+        else:
+            track = threading.current_thread().name
+        with self._lock:
+            event['tid'] = self._track(track)
+            self._file.write(json.dumps(event) + ',\n')
+
+
+    def finish(self, item):
+        pass
+
+
+    def close(self):
+        '''Writes the names of the tracks and closes the file.'''
+        with self._lock:
+            if __debug__: log('Finishing trace in {}', self._file.name)
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                      'args': {'name': name}} for (name, tid) in self._tracks.items()]
+            names.append({'name': 'process_name', 'ph': 'M', 'pid': self._pid,
+                          'args': {'name': 'handprint'}})
+            self._file.write(',\n'.join(json.dumps(n) for n in names) + '\n]\n')
+            self._file.close()
+
+
+    def _track(self, name):
+        if name not in self._tracks:
+            self._tracks[name] = len(self._tracks) + 1
+        return self._tracks[name]
+
+
+# Helper functions.
+# .............................................................................
+
+def _in_event_loop():
+    '''Returns True if the calling thread is running an asyncio event loop.'''
+    # asyncio is slow to import, and can only be in use if it's imported.
+    asyncio = sys.modules.get('asyncio')
+    return asyncio is not None and asyncio._get_running_loop() is not None
+
+
+def percentile(values, p):
+    '''Returns the 'p'th percentile of the sorted list 'values', using the
+    nearest-rank method.'''
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
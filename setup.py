@@ -49,5 +49,5 @@ setup(
     scripts          = ['bin/handprint'],
     install_requires = reqs,
     platforms        = 'any',
-    python_requires  = '>=3',
+    python_requires  = '>=3.7',
 )
\ No newline at end of file
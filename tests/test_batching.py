@@ -0,0 +1,89 @@
+'''
+test_batching.py: tests for split_batches() and RequestBatcher in
+handprint.htr.base.
+'''
+
+import threading
+
+import pytest
+
+from handprint.htr.base import RequestBatcher, split_batches
+
+
+def items(*sizes):
+    return [('item{}'.format(n), b'x' * size) for (n, size) in enumerate(sizes)]
+
+
+def keys(batches):
+    return [[key for (key, _) in batch] for batch in batches]
+
+
+def test_split_by_count():
+    batches = split_batches(items(1, 1, 1, 1, 1), 2, 1000)
+    assert keys(batches) == [['item0', 'item1'], ['item2', 'item3'], ['item4']]
+
+
+def test_split_by_bytes():
+    batches = split_batches(items(40, 40, 40, 10, 90), 10, 100)
+    assert keys(batches) == [['item0', 'item1'], ['item2', 'item3'], ['item4']]
+
+
+def test_oversized_item_is_alone():
+    batches = split_batches(items(10, 500, 10), 10, 100)
+    assert keys(batches) == [['item0'], ['item1'], ['item2']]
+
+
+def test_nothing_to_split():
+    assert split_batches([], 10, 100) == []
+
+
+def test_order_and_contents_kept():
+    original = items(30, 60, 20, 70, 10, 10, 10)
+    batches = split_batches(original, 3, 100)
+    assert [item for batch in batches for item in batch] == original
+    for batch in batches:
+        assert len(batch) <= 3
+        assert sum(len(data) for (_, data) in batch) <= 100
+
+
+def test_batcher_single_caller_sends_at_once():
+    sent = []
+    def send(batch):
+        sent.append(batch)
+        return {key: len(data) for (key, data) in batch}
+    batcher = RequestBatcher(send, 10, 1000, window = 60)
+    with batcher.caller():
+        # With no other callers, this must not wait for the window.
+        assert batcher.submit('a', b'xyz') == 3
+    assert keys(sent) == [['a']]
+
+
+def test_batcher_combines_concurrent_requests():
+    sent = []
+    def send(batch):
+        sent.append(batch)
+        return {key: data.upper() for (key, data) in batch}
+    batcher = RequestBatcher(send, 4, 1000, window = 5)
+    results = {}
+    barrier = threading.Barrier(4)
+    def work(n):
+        with batcher.caller():
+            barrier.wait()
+            results[n] = batcher.submit(n, b'item %d' % n)
+    threads = [threading.Thread(target = work, args = (n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == {n: b'ITEM %d' % n for n in range(4)}
+    assert len(sent) == 1
+    assert sorted(keys(sent)[0]) == [0, 1, 2, 3]
+
+
+def test_batcher_raises_errors_from_send():
+    def send(batch):
+        raise ValueError('service failed')
+    batcher = RequestBatcher(send, 10, 1000)
+    with batcher.caller():
+        with pytest.raises(ValueError):
+            batcher.submit('a', b'data')
@@ -0,0 +1,86 @@
+'''
+test_cache.py: tests for handprint.cache.
+'''
+
+import os
+from   os import path
+import time
+
+from handprint.cache import ResultCache
+
+
+# Each entry is a little over 1000 bytes, so a cache of 2500 bytes holds two.
+_RESULTS = {'text': 'x' * 1000}
+_MAX_BYTES = 2500
+
+
+def make_cache(dir, **kwargs):
+    cache = ResultCache(str(dir), **kwargs)
+    # Don't let the index built in the background race with the tests.
+    cache.evict()
+    return cache
+
+
+def set_last_use(cache, key, when):
+    os.utime(cache._file(key), (when, when))
+
+
+def test_put_and_get(tmp_path):
+    cache = make_cache(tmp_path)
+    key = cache.key('microsoft', {'mode': 'Handwritten'}, b'image')
+    assert cache.get(key) is None
+    cache.put(key, {'text': 'hello'})
+    assert cache.get(key) == {'text': 'hello'}
+
+
+def test_key_depends_on_method_params_and_data():
+    cache = ResultCache.__new__(ResultCache)
+    key = cache.key('microsoft', {'a': 1, 'b': 2}, b'image')
+    assert key == cache.key('microsoft', {'b': 2, 'a': 1}, b'image')
+    assert key != cache.key('google', {'a': 1, 'b': 2}, b'image')
+    assert key != cache.key('microsoft', {'a': 1}, b'image')
+    assert key != cache.key('microsoft', {'a': 1, 'b': 2}, b'other')
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_bytes = _MAX_BYTES)
+    cache.put('aa1', _RESULTS)
+    cache.put('bb2', _RESULTS)
+    assert cache.get('aa1') == _RESULTS      # Now 'bb2' is the oldest.
+    cache.put('cc3', _RESULTS)
+    assert cache.get('bb2') is None
+    assert not path.exists(cache._file('bb2'))
+    assert cache.get('aa1') == _RESULTS
+    assert cache.get('cc3') == _RESULTS
+
+
+def test_entries_expire_by_last_use(tmp_path):
+    cache = make_cache(tmp_path, max_age = 100)
+    cache.put('aa1', _RESULTS)
+    cache.put('bb2', _RESULTS)
+    set_last_use(cache, 'aa1', time.time() - 50)
+    set_last_use(cache, 'bb2', time.time() - 200)
+    assert cache.get('aa1') == _RESULTS
+    assert cache.get('bb2') is None
+    assert not path.exists(cache._file('bb2'))
+
+
+def test_use_renews_entry(tmp_path):
+    cache = make_cache(tmp_path, max_age = 100)
+    cache.put('aa1', _RESULTS)
+    set_last_use(cache, 'aa1', time.time() - 80)
+    assert cache.get('aa1') == _RESULTS
+    assert time.time() - os.stat(cache._file('aa1')).st_mtime < 10
+
+
+def test_evict_rebuilds_index_from_files(tmp_path):
+    cache = make_cache(tmp_path)
+    for (n, key) in enumerate(['aa1', 'bb2', 'cc3']):
+        cache.put(key, _RESULTS)
+        set_last_use(cache, key, time.time() - 100 + n)
+    # A new cache over the same directory keeps the most recently used.
+    cache = make_cache(tmp_path, max_bytes = _MAX_BYTES)
+    assert not path.exists(cache._file('aa1'))
+    assert cache.get('bb2') == _RESULTS
+    assert cache.get('cc3') == _RESULTS
+    assert cache._bytes == sum(os.stat(cache._file(k)).st_size for k in ['bb2', 'cc3'])
@@ -0,0 +1,66 @@
+'''
+test_journal.py: tests for handprint.journal.
+'''
+
+import json
+
+from handprint.journal import Journal
+
+
+def test_records_status_of_this_run(tmp_path):
+    journal = Journal(str(tmp_path / 'journal'))
+    journal.started('a.png', 'google')
+    journal.done('a.png', 'google', 'a.google.txt')
+    journal.started('b.png', 'google')
+    journal.failed('b.png', 'google', 'Service unavailable')
+    journal.started('c.png', 'google')
+    assert journal.completed('a.png', 'google')
+    assert not journal.completed('b.png', 'google')
+    assert not journal.completed('a.png', 'microsoft')
+    assert journal.summary() == {('a.png', 'google'): 'done',
+                                 ('b.png', 'google'): 'failed',
+                                 ('c.png', 'google'): 'started'}
+    assert journal.errors() == {('b.png', 'google'): 'Service unavailable'}
+    journal.close()
+
+
+def test_resume_skips_only_completed_work(tmp_path):
+    file = str(tmp_path / 'journal')
+    journal = Journal(file)
+    journal.done('a.png', 'google')
+    journal.failed('b.png', 'google', 'Error')
+    journal.started('c.png', 'google')
+    journal.close()
+
+    journal = Journal(file)
+    assert journal.completed('a.png', 'google')
+    assert not journal.completed('b.png', 'google')
+    assert not journal.completed('c.png', 'google')
+    # Only the outcomes of the new run are summarized.
+    assert journal.summary() == {}
+    journal.done('b.png', 'google')
+    assert journal.completed('b.png', 'google')
+    journal.close()
+
+
+def test_later_records_override_earlier_ones(tmp_path):
+    file = str(tmp_path / 'journal')
+    journal = Journal(file)
+    journal.done('a.png', 'google')
+    journal.failed('a.png', 'google', 'Error')
+    journal.close()
+    assert not Journal(file).completed('a.png', 'google')
+
+
+def test_incomplete_last_line_is_ignored(tmp_path):
+    file = tmp_path / 'journal'
+    done = {'time': 0, 'status': 'done', 'item': 'a.png', 'method': 'google'}
+    file.write_text(json.dumps(done) + '\n{"time": 1, "status": "do')
+    journal = Journal(str(file))
+    assert journal.completed('a.png', 'google')
+    journal.done('b.png', 'google')
+    journal.close()
+    # The new record starts on a line of its own.
+    journal = Journal(str(file))
+    assert journal.completed('b.png', 'google')
+    journal.close()
@@ -0,0 +1,60 @@
+'''
+test_ordered_map.py: tests for handprint.engine.ordered_map().
+'''
+
+import random
+import threading
+import time
+
+import pytest
+
+from handprint.engine import ordered_map
+
+
+def slow_square(n):
+    # Finish out of order, so that the order of the results is tested.
+    time.sleep(random.uniform(0, 0.01))
+    return n * n
+
+
+@pytest.mark.parametrize('workers', [1, 2, 8])
+def test_results_in_order(workers):
+    assert list(ordered_map(slow_square, range(50), workers)) == [n * n for n in range(50)]
+
+
+def test_empty():
+    assert list(ordered_map(slow_square, [], 4)) == []
+
+
+def test_uses_several_threads():
+    threads = set()
+    def record(n):
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+        return n
+    assert list(ordered_map(record, range(20), 4)) == list(range(20))
+    assert len(threads) > 1
+
+
+def test_items_consumed_lazily():
+    consumed = []
+    def generate():
+        for n in range(10000):
+            consumed.append(n)
+            yield n
+    results = ordered_map(lambda n: n, generate(), 2)
+    assert next(results) == 0
+    # Only a limited number of items are scheduled ahead.
+    assert len(consumed) < 100
+    results.close()
+
+
+def test_exception_is_raised_in_order():
+    def fail_on_three(n):
+        if n == 3:
+            raise ValueError('bad item')
+        return n
+    results = ordered_map(fail_on_three, range(100), 4)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(results)
@@ -0,0 +1,91 @@
+'''
+test_rate_limiter.py: tests for handprint.htr.base.RateLimiter.
+'''
+
+import pytest
+
+import handprint.htr.base
+from handprint.htr.base import RateLimiter, rate_limiter
+
+
+class Clock(object):
+    '''Stands in for the time module, so that the tests don't have to wait.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(handprint.htr.base, 'time', clock)
+    return clock
+
+
+def test_burst_then_paced(clock):
+    limiter = RateLimiter(10)
+    # A full bucket lets one second's worth through at once.
+    assert [limiter.reserve() for _ in range(10)] == [0] * 10
+    # After that, each request waits for the next token.
+    assert limiter.reserve() == pytest.approx(0.1)
+    assert limiter.reserve() == pytest.approx(0.2)
+
+
+def test_tokens_accumulate_up_to_burst(clock):
+    limiter = RateLimiter(10, burst = 2)
+    limiter.reserve(2)
+    clock.now += 60
+    assert limiter.reserve(2) == 0
+    assert limiter.reserve() == pytest.approx(0.1)
+
+
+def test_cost_of_several_tokens(clock):
+    limiter = RateLimiter(4)
+    assert limiter.reserve(4) == 0
+    assert limiter.reserve(2) == pytest.approx(0.5)
+
+
+def test_take_sleeps_for_the_wait(clock):
+    limiter = RateLimiter(2)
+    start = clock.now
+    for _ in range(4):
+        limiter.take()
+    assert clock.now - start == pytest.approx(1.0)
+
+
+def test_no_rate_means_no_waiting(clock):
+    limiter = RateLimiter(None)
+    assert [limiter.reserve() for _ in range(1000)] == [0] * 1000
+
+
+def test_pause_holds_back_requests(clock):
+    limiter = RateLimiter(None)
+    limiter.pause(5)
+    assert limiter.reserve() == pytest.approx(5)
+    clock.now += 5
+    assert limiter.reserve() == 0
+
+
+def test_no_burst_after_pause(clock):
+    limiter = RateLimiter(10)
+    limiter.pause(5)
+    # Tokens only start to accumulate again when the pause ends.
+    assert limiter.reserve() == pytest.approx(5.1)
+    clock.now += 60
+    assert limiter.reserve() == 0
+
+
+def test_limiters_shared_per_service_and_credentials():
+    first = rate_limiter('test-service', 'key1', 5)
+    assert rate_limiter('test-service', 'key1', 5) is first
+    assert rate_limiter('test-service', 'key2', 5) is not first
+    assert rate_limiter('other-service', 'key1', 5) is not first
+    # Changing the rate changes it for everyone using the limiter.
+    assert rate_limiter('test-service', 'key1', 8) is first
+    assert first.rate == 8